@@ -3,36 +3,154 @@ import numpy as np
 
 
 
+def convex_hulls(points,offsets,prefilter=False):
+    """ convex hulls and areas for a batch of clusters
+
+        The points of cluster k are points[offsets[k]:offsets[k+1]]. All of
+        the points are sorted in a single lexsort, each hull is found with
+        a monotone chain over the sorted points, and the areas are computed
+        for all of the hulls at once.
+
+        Args:
+            points<arr>: array of [i,j] valued (integer) arrays
+            offsets<arr>: cluster start indices followed by len(points)
+            prefilter<bool[False]>: if true drop points that are not
+                row and column extrema (see extrema) before the hulls
+                are computed
+
+        Returns:
+            (hulls, areas). hulls is a list of closed hulls (the first
+            vertex is repeated at the end), areas an array of hull areas
+    """
+    points=np.asarray(points)
+    offsets=np.asarray(offsets)
+    groups=np.repeat(
+        np.arange(offsets.shape[0]-1),
+        np.diff(offsets))
+    if prefilter:
+        is_extreme=extrema(points,groups)
+        points=points[is_extreme]
+        groups=groups[is_extreme]
+        offsets=np.concatenate(([0],np.cumsum(
+            np.bincount(groups,minlength=offsets.shape[0]-1))))
+    order=np.lexsort((points[:,1],points[:,0],groups))
+    sorted_points=points[order].tolist()
+    hulls=[
+        _closed(_monotone_chain(sorted_points[start:end]))
+        for start,end in zip(offsets[:-1],offsets[1:])]
+    return hulls, areas(hulls)
+
+
+def extrema(points,groups=None):
+    """ mask of the points that can be hull vertices
+
+        On the integer pixel grid a hull vertex must be both the leftmost
+        or rightmost point in its row and the topmost or bottommost point
+        in its column. For a cluster in a SIZExSIZE tile that leaves at most
+        ~2*SIZE candidates.
+
+        Args:
+            points<arr>: array of [i,j] valued (integer) arrays
+            groups<arr>: cluster index for each point (defaults to one cluster)
+    """
+    if groups is None:
+        groups=np.zeros(points.shape[0],dtype=int)
+    return (
+        _line_extrema(groups,points[:,0],points[:,1]) &
+        _line_extrema(groups,points[:,1],points[:,0]))
+
+
+def _line_extrema(groups,lines,positions):
+    order=np.lexsort((positions,lines,groups))
+    keys=np.column_stack((groups[order],lines[order]))
+    positions=positions[order]
+    is_new=np.ones(order.shape[0]+1,dtype=bool)
+    is_new[1:-1]=(keys[1:]!=keys[:-1]).any(axis=1)
+    runs=np.cumsum(is_new[:-1])-1
+    is_extreme=np.zeros(order.shape[0],dtype=bool)
+    is_extreme[order]=(
+        (positions==positions[is_new[:-1]][runs]) |
+        (positions==positions[is_new[1:]][runs]))
+    return is_extreme
+
+
+def areas(hulls):
+    """ shoelace areas for a list of closed hulls
+    """
+    if not len(hulls):
+        return np.zeros(0)
+    sizes=np.array([len(hull) for hull in hulls])
+    starts=np.concatenate(([0],np.cumsum(sizes)[:-1]))
+    rings=np.concatenate([np.asarray(hull,dtype=float) for hull in hulls])
+    x,y=rings[:,0],rings[:,1]
+    terms=x[:-1]*y[1:]-x[1:]*y[:-1]
+    terms=np.append(terms,0)
+    terms[starts[1:]-1]=0
+    return 0.5*np.abs(np.add.reduceat(terms,starts))
+
+
+def _monotone_chain(points):
+    """ andrew's monotone chain
+        https://en.wikibooks.org/wiki/Algorithm_Implementation/Geometry/Convex_hull/Monotone_chain
+
+        Args:
+            points<list>: lexicographically sorted list of [i,j] lists
+    """
+    points=_unique(points)
+    if len(points)<3:
+        return points
+    lower=[]
+    for p in points:
+        while (len(lower)>=2) and (_cross(lower[-2],lower[-1],p)<=0):
+            lower.pop()
+        lower.append(p)
+    upper=[]
+    for p in reversed(points):
+        while (len(upper)>=2) and (_cross(upper[-2],upper[-1],p)<=0):
+            upper.pop()
+        upper.append(p)
+    return lower[:-1]+upper[:-1]
+
+
+def _cross(o,a,b):
+    return (a[0]-o[0])*(b[1]-o[1])-(a[1]-o[1])*(b[0]-o[0])
+
+
+def _unique(points):
+    unique=[]
+    for p in points:
+        if not unique or (p!=unique[-1]):
+            unique.append(p)
+    return unique
+
+
+def _closed(hull):
+    return hull+hull[:1]
+
+
+
+
 class ConvexHull(object):
     #
     # PUBLIC METHODS
     #
-    def __init__(self,points):
+    def __init__(self,points,prefilter=False):
         self.points=points
+        if prefilter:
+            points=np.asarray(points)
+            points=points[extrema(points)]
         self.hull=self._convex_hull(points)
         self.area=self._area(self.hull)
 
 
     """ compute convex hull
-        https://medium.com/100-days-of-algorithms/day-28-convex-hull-bc84b678da06
+        monotone chain over the lexicographically sorted points
     """
-    def _split(self,u, v, points):
-        return [p for p in points if np.cross(p - u, v - u) < 0]
-
-
-    def _extend(self,u, v, points):
-        if not points:
-            return []
-        w = min(points, key=lambda p: np.cross(p - u, v - u))
-        p1, p2 = self._split(w, v, points), self._split(u, w, points)
-        return self._extend(w, v, p1) + [w] + self._extend(u, w, p2)
-
-
     def _convex_hull(self,points):
-        u = min(points, key=lambda p: p[0])
-        v = max(points, key=lambda p: p[0])
-        left, right = self._split(u, v, points), self._split(v, u, points)
-        return np.array([v] + self._extend(u, v, left) + [u] + self._extend(v, u, right) + [v])
+        points=np.asarray(points)
+        order=np.lexsort((points[:,1],points[:,0]))
+        hull=_closed(_monotone_chain(points[order].tolist()))
+        return np.array(hull)
 
 
     """ compute area
@@ -41,4 +159,4 @@ class ConvexHull(object):
     def _area(self,pts_arr):
         x=pts_arr[:,0]
         y=pts_arr[:,1]
-        return 0.5*np.abs(np.dot(x,np.roll(y,1))-np.dot(y,np.roll(x,1))) 
\ No newline at end of file
+        return 0.5*np.abs(np.dot(x,np.roll(y,1))-np.dot(y,np.roll(x,1)))
@@ -0,0 +1,74 @@
+import numpy as np
+
+DATE_STR_FMT='%Y-%m-%d'
+INT_DATE_FMT='%Y%m%d'
+GLAD_START_DATE='2015-01-01'
+FORMA_START_DATE='2012-01-01'
+START_DATES={
+    'GLAD': GLAD_START_DATE,
+    'FORMA': FORMA_START_DATE }
+MAX_DAYS=2**16
+
+
+""" days-since-epoch to yyyymmdd lookup table
+
+    The table starts at the earliest epoch (FORMA) and covers every value
+    the two-band days encoding can hold for either epoch. Days since the
+    GLAD epoch are offset into the table by EPOCH_OFFSETS['GLAD'].
+"""
+def _date_ints(start_date,nb_days):
+    dates=np.datetime64(start_date,'D')+np.arange(nb_days)
+    years=dates.astype('M8[Y]')
+    months=dates.astype('M8[M]')
+    return (
+        (years.astype(int)+1970)*10000+
+        ((months-years).astype(int)+1)*100+
+        ((dates-months).astype(int)+1))
+
+
+LUT_START_DATE=min(START_DATES.values())
+EPOCH_OFFSETS={
+    image_type: int(
+        (np.datetime64(start_date,'D')-np.datetime64(LUT_START_DATE,'D')).astype(int))
+    for image_type,start_date in START_DATES.items() }
+DATE_INTS=_date_ints(LUT_START_DATE,MAX_DAYS+max(EPOCH_OFFSETS.values()))
+
+
+def days_to_int(days,image_type=None):
+    """ days-since-epoch to yyyymmdd ints
+
+        Args:
+            days<int|arr>: days since the GLAD (or FORMA) epoch
+            image_type<str>: 'GLAD' (default) or 'FORMA'
+    """
+    return DATE_INTS[np.asarray(days).astype(int)+_offset(image_type)]
+
+
+def int_to_days(date_ints,image_type=None):
+    """ yyyymmdd ints to days-since-epoch
+
+        Args:
+            date_ints<int|arr>: yyyymmdd dates
+            image_type<str>: 'GLAD' (default) or 'FORMA'
+    """
+    return np.searchsorted(DATE_INTS,date_ints)-_offset(image_type)
+
+
+def int_to_str(date_ints):
+    """ yyyymmdd ints to 'yyyy-mm-dd' strs
+    """
+    days=np.searchsorted(DATE_INTS,date_ints)
+    return (np.datetime64(LUT_START_DATE,'D')+days).astype(str)
+
+
+def str_to_days(date_strs,image_type=None):
+    """ 'yyyy-mm-dd' strs to days-since-epoch
+    """
+    start_date=START_DATES.get(image_type,GLAD_START_DATE)
+    return (
+        np.asarray(date_strs,dtype='M8[D]')-
+        np.datetime64(start_date,'D')).astype(int)
+
+
+def _offset(image_type):
+    return EPOCH_OFFSETS.get(image_type,EPOCH_OFFSETS['GLAD'])
@@ -0,0 +1,71 @@
+import numpy as np
+
+SIZE=256
+TRUNCATE=4
+OFFSETS=[(0,0)]+[
+    (di,dj) for di in (-1,0,1) for dj in (-1,0,1) if (di or dj)]
+
+
+def gaussian_matrix(width,size=SIZE,cutoff=None):
+    """ banded matrix for a 1-d gaussian convolution along one axis
+
+        Args:
+            width<float>: gaussian width
+            size<int>: number of pixels along the axis
+            cutoff<float>: truncate the kernel beyond cutoff pixels
+                (defaults to TRUNCATE*width)
+    """
+    if cutoff is None: cutoff=TRUNCATE*width
+    offsets=np.subtract.outer(np.arange(size),np.arange(size))
+    kernel=np.exp(-0.5*(offsets/float(width))**2)
+    kernel[np.abs(offsets)>cutoff]=0
+    return kernel
+
+
+def density(mask,width,cutoff=None):
+    """ gaussian kernel density of a 2-d alert mask
+
+        The 2-d gaussian is separable so the convolution is computed as
+        two matrix products: K.mask.K^T.
+
+        Args:
+            mask<arr>: SIZExSIZE array of alert counts
+            width<float>: gaussian width
+            cutoff<float>: see gaussian_matrix
+    """
+    kernel=gaussian_matrix(width,mask.shape[0],cutoff)
+    return kernel.dot(mask).dot(kernel.T)
+
+
+def hill_climb(dens):
+    """ find the mode each pixel climbs to
+
+        Each pixel points at the highest of its 8 neighbors if that is
+        higher than itself. The pointers are then followed (by pointer
+        doubling) until every pixel points at a local maximum.
+
+        Args:
+            dens<arr>: SIZExSIZE density
+
+        Returns:
+            (modes, nb_steps) where modes is the SIZExSIZE array of flat
+            indices of the mode for each pixel
+    """
+    nb_rows,nb_cols=dens.shape
+    padded=np.pad(dens,1,mode='constant',constant_values=-np.inf)
+    shifted=np.stack([
+        padded[1+di:1+di+nb_rows,1+dj:1+dj+nb_cols] for di,dj in OFFSETS])
+    best=np.argmax(shifted,axis=0)
+    offsets=np.array(OFFSETS)
+    rows,cols=np.indices(dens.shape)
+    modes=(
+        (rows+offsets[best,0])*nb_cols+
+        (cols+offsets[best,1])).reshape(-1)
+    nb_steps=0
+    while True:
+        jumped=modes[modes]
+        if np.array_equal(jumped,modes):
+            break
+        modes=jumped
+        nb_steps+=1
+    return modes.reshape(dens.shape), nb_steps
@@ -1,18 +1,105 @@
 import math
+import copy
 import numpy as np
-from glad_clusters.clusters.convex_hull import ConvexHull
-import glad_clusters.clusters.processors as proc
+from glad_clusters.clusters.convex_hull import convex_hulls
+from glad_clusters.clusters.neighbors import GridIndex
+import glad_clusters.clusters.density as density
+import glad_clusters.clusters.dates as dates
 
 NOISY=False
 INPUT_DATA=False
 WIDTH=15
 MIN_COUNT=6
 ITERATIONS=25
+LOOP_ENGINE='loop'
+BLOCK_ENGINE='block'
+GRID_ENGINE='grid'
+ENGINES=[LOOP_ENGINE,BLOCK_ENGINE,GRID_ENGINE]
+ENGINE=LOOP_ENGINE
+BLOCK_SIZE=256
+CUTOFF=None
+TOLERANCE=None
+MERGE=None
+SEEDS=None
+CENTROIDS=None
+WARM_TOLERANCE=0.1
+EXACT_MODE='exact'
+SEEDED_MODE='seeded'
+GRID_MODE='grid'
+HULL_PREFILTER=True
 SIZE=256
 INDICES=np.indices((SIZE,SIZE))
 SHIFT=(SIZE-1)/2.0
 
 class MShift(object):
+    """ MShift:
+
+        Mean-shift clustering of the alerts in a single GLAD tile.
+
+        Args:
+            data<arr>: SIZExSIZE image of days-since values (0 for no alert)
+            alerts<arr>:
+                sparse alternative to data: array of [i,j,days-since]
+                valued arrays (see handler.glad_alerts)
+            image_type<str>: 'GLAD' (default) or 'FORMA'. sets the epoch for
+                the days-since values
+            width<int>: gaussian width
+            min_count<int>: minimum number of alerts in a cluster
+            iterations<int>: number of mean-shift iterations
+            engine<str[ENGINE]>:
+                'loop': reference engine. shifts one point at a time, each
+                    update seeing the points already moved this iteration.
+                'block': shifts every point against the positions from the
+                    previous iteration, computing block_size rows of the
+                    distance matrix at a time.
+                'grid': computes the kernel density of the alerts on the
+                    SIZExSIZE pixel grid (a separable convolution) and
+                    hill-climbs from each alert pixel to its density mode.
+                    cost depends on SIZE rather than the number of alerts.
+                    iterations, block_size, tolerance and merge are ignored.
+            block_size<int[BLOCK_SIZE]>:
+                number of points per block for the 'block' engine. peak
+                memory is roughly 3*8*block_size*nb_alerts bytes
+            cutoff<float[CUTOFF]>:
+                if set ('block' or 'grid' engines), truncate the kernel at cutoff
+                pixels. the 'block' engine then only compares points in
+                neighboring grid cells.
+                each dropped weight is less than kernel_tolerance(width,cutoff)
+                times the peak weight (3.4e-4 at cutoff=4*width, 3.7e-6 at
+                5*width), so for cutoff>=4*width the shifted positions agree
+                with the exact kernel to well within the final rounding.
+            tolerance<float[TOLERANCE]>:
+                if set, points that move less than tolerance pixels in an
+                iteration are frozen (they stay in the data but are no longer
+                shifted) and iteration stops once every point is frozen.
+                the number of iterations actually run is nb_iterations.
+            merge<float[MERGE]>:
+                if set, after each iteration points that fall in the same
+                merge-by-merge pixel cell are collapsed into a single point
+                at their weighted mean, carrying the combined weight. each
+                alert keeps track of the point it was merged into, so
+                clustered_data() still returns one row per alert.
+            seeds<int[SEEDS]>:
+                seed budget. if set and the tile has more than seeds alerts,
+                the alerts are binned into at most seeds coarse pixel bins,
+                only the bin means (weighted by their alert counts) are
+                shifted, and every alert is then labeled with the mode its
+                own bin converged to. ignored by the 'grid' engine. mode
+                records whether the 'exact', 'seeded' or 'grid' path was used.
+            centroids<arr[CENTROIDS]>:
+                warm start: array of [i,j] cluster centroids from a previous
+                run on the tile. before shifting, every point within width
+                pixels of a centroid is moved onto the nearest centroid, and
+                (if tolerance is not set) iteration stops once no point moves
+                more than WARM_TOLERANCE pixels. a tile that only gained a few
+                alerts near its previous clusters then converges in a few
+                iterations. ignored by the 'grid' engine.
+    """
+    @staticmethod
+    def kernel_tolerance(width,cutoff):
+        """ relative gaussian weight at the cutoff radius
+        """
+        return math.exp(-0.5*(float(cutoff)/width)**2)
 
 
     @staticmethod
@@ -28,14 +115,37 @@ class MShift(object):
     # PUBLIC METHODS
     #
     def __init__(self,
-            data,
+            data=None,
             width=WIDTH,
             min_count=MIN_COUNT,
-            iterations=ITERATIONS):
+            iterations=ITERATIONS,
+            engine=ENGINE,
+            block_size=BLOCK_SIZE,
+            cutoff=CUTOFF,
+            tolerance=TOLERANCE,
+            merge=MERGE,
+            seeds=SEEDS,
+            centroids=CENTROIDS,
+            alerts=None,
+            image_type=None):
+        if engine not in ENGINES:
+            raise ValueError('engine must be one of {}'.format(ENGINES))
+        if cutoff and (engine==LOOP_ENGINE):
+            raise ValueError('cutoff is not supported by the {} engine'.format(
+                LOOP_ENGINE))
         self.data=data
+        self.alerts=alerts
+        self.image_type=image_type
         self.width=width
         self.min_count=min_count
         self.iterations=iterations
+        self.engine=engine
+        self.block_size=block_size
+        self.cutoff=cutoff
+        self.tolerance=tolerance
+        self.merge=merge
+        self.seeds=seeds
+        self.centroids=centroids
         self._init_properties()
 
 
@@ -45,9 +155,12 @@ class MShift(object):
             Returns: 
                 array of [i,j,days-since] valued arrays
         """
-        self._ij_data=np.dstack((INDICES[0],INDICES[1],self.data))
-        self._ij_data=self._ij_data.reshape(SIZE**2,-1)
-        self._ij_data=self._ij_data[self._ij_data[:,-1]>0]
+        if self._ij_data is None and self.alerts is not None:
+            self._ij_data=np.asarray(self.alerts).reshape(-1,3)
+        elif self._ij_data is None:
+            self._ij_data=np.dstack((INDICES[0],INDICES[1],self.data))
+            self._ij_data=self._ij_data.reshape(SIZE**2,-1)
+            self._ij_data=self._ij_data[self._ij_data[:,-1]>0]
         return self._ij_data
 
 
@@ -60,74 +173,108 @@ class MShift(object):
                 array of [i,j] valued arrays
         """
         if self._clustered_data is None:
-            cdata=self.ij_data()[:,:2].copy()
-            cdata=np.subtract(cdata,SHIFT)
-            for n in range(self.iterations):
-                if NOISY: 
-                    if (n+1)%5==0: print("...{}/{}".format(n+1,self.iterations))
-                for i, x in enumerate(cdata):
-                    dist=np.sqrt(((x-cdata)**2).sum(1))
-                    weight=self._gaussian(dist)
-                    cdata[i]=(
-                        np.expand_dims(weight,1)*cdata).sum(0)/weight.sum()
-            self._clustered_data=np.add(cdata,SHIFT).round().astype(int)
+            if self.engine==GRID_ENGINE:
+                self.mode=GRID_MODE
+                self._clustered_data=self._grid_modes()
+            elif self.seeds and (self.ij_data().shape[0]>self.seeds):
+                self.mode=SEEDED_MODE
+                self._clustered_data=self._seeded_modes()
+            else:
+                self.mode=EXACT_MODE
+                cdata=self.ij_data()[:,:2].copy()
+                cdata=np.subtract(cdata,SHIFT)
+                cdata,labels=self._mean_shift(cdata,np.ones(cdata.shape[0]))
+                self._clustered_data=np.add(
+                    cdata[labels],SHIFT).round().astype(int)
         return self._clustered_data
 
 
-    def clusters(self):
+    def clusters(self,min_count=None):
         """ group into clusters
             
             * groups points at a given i,j
             * thresholds for nb_pts>min_count
 
+            Args:
+                min_count<int>: if set, use in place of self.min_count
+
             Returns: 
                 array of [i,j,count] valued arrays
         """
+        if min_count is None: min_count=self.min_count
         if self._clusters is None:
             if self.clustered_data().shape[0]==0:
                 self._clusters=[]
             else:
-                points,counts=np.unique(
-                    self.clustered_data(),
-                    axis=0,
-                    return_counts=True)
-                counts=np.expand_dims(counts,axis=-1)
-                self._clusters=np.concatenate(
-                    (points,counts),
-                    axis=-1)
-                self._clusters=self._clusters[
-                    self._clusters[:,-1]>=self.min_count]
-        return self._clusters
-
-
-    def clusters_data(self):
+                groups=self._groups()
+                self._clusters=np.column_stack((
+                    groups['points'],
+                    groups['counts']))
+        if len(self._clusters):
+            return self._clusters[self._clusters[:,-1]>=min_count]
+        else:
+            return self._clusters
+
+
+    def clusters_data(self,min_count=None,summary=False):
         """ dictionary
+
+            Args:
+                min_count<int>: if set, use in place of self.min_count
+                summary<bool[False]>: if true omit the alerts for each cluster
         """
+        if min_count is None: min_count=self.min_count
+        clusters=self.clusters(min_count)
         cluster_dict={}
         if INPUT_DATA: cluster_dict['input_data']=self.ij_data().astype(int).tolist()
-        cluster_dict['nb_clusters']=len(self.clusters())
-        cluster_dict['clusters']=[
-            self.cluster_data(c) for c in self.clusters()]
+        cluster_dict['nb_clusters']=len(clusters)
+        cluster_dict['nb_iterations']=self.nb_iterations
+        cluster_dict['mode']=self.mode
+        if len(clusters):
+            group_ids=np.nonzero(self._groups()['counts']>=min_count)[0]
+            cluster_dict['clusters']=self._groups_data(group_ids,summary)
+        else:
+            cluster_dict['clusters']=[]
         return cluster_dict
 
 
+    def sweep(self,widths,min_counts,summary=False):
+        """ clusters_data for every width/min_count combination
+
+            The alert data is shared across widths, and each width is
+            shifted once and grouped once for all of the min_counts.
+
+            Args:
+                widths<list>: gaussian widths
+                min_counts<list>: minimum number of alerts in a cluster
+                summary<bool[False]>: if true omit the alerts for each cluster
+
+            Returns:
+                list of clusters_data dictionaries with additional
+                width and min_count keys
+        """
+        results=[]
+        for width in widths:
+            if width==self.width:
+                mshift=self
+            else:
+                mshift=copy.copy(self)
+                mshift.width=width
+                mshift._init_properties()
+                mshift._ij_data=self.ij_data()
+            for min_count in min_counts:
+                data=mshift.clusters_data(min_count,summary)
+                data['width']=width
+                data['min_count']=min_count
+                results.append(data)
+        return results
+
+
     def cluster_data(self,cluster):
         """ dictionary
         """
         i,j,count=cluster
-        alerts=self._alerts_for_points(i,j)
-        area=ConvexHull(alerts[:,:-1]).area
-        min_date=proc.date_for_days(np.amin(alerts[:,-1]))
-        max_date=proc.date_for_days(np.amax(alerts[:,-1]))
-        cluster_dict={
-            'i':i,
-            'j':j,
-            'count':count,
-            'area':int(round(area)),
-            'max_date':max_date,
-            'min_date':min_date,
-            'alerts':alerts.astype(int).tolist() }
-        return cluster_dict
+        return self._groups_data(np.array([self._group_index(i,j)]))[0]
 
 
     #
@@ -136,23 +283,244 @@ class MShift(object):
     def _init_properties(self):
         self._ij_data=None
         self._clustered_data=None
-        self._joined=None
+        self._grouped=None
+        self._group_ids=None
         self._clusters=None
+        self.nb_iterations=None
+        self.mode=None
 
 
-    def _joined_data(self):
-        if self._joined is None:
-            self._joined=np.concatenate(
-                (self.clustered_data(),self.ij_data()),axis=-1)
-        return self._joined
+    def _groups(self):
+        """ partition the alerts by clustered i,j
 
+            a single unique/argsort pass: the alerts of group g are the
+            contiguous rows alerts[offsets[g]:offsets[g+1]]
+        """
+        if self._grouped is None:
+            points,inverse,counts=np.unique(
+                self.clustered_data(),
+                axis=0,
+                return_inverse=True,
+                return_counts=True)
+            order=np.argsort(inverse.reshape(-1),kind='mergesort')
+            alerts=self.ij_data()[order]
+            offsets=np.concatenate(([0],np.cumsum(counts)))
+            self._grouped={
+                'points': points,
+                'counts': counts,
+                'alerts': alerts,
+                'offsets': offsets,
+                'min_dates': dates.days_to_int(
+                    np.minimum.reduceat(alerts[:,-1],offsets[:-1]),
+                    self.image_type),
+                'max_dates': dates.days_to_int(
+                    np.maximum.reduceat(alerts[:,-1],offsets[:-1]),
+                    self.image_type) }
+        return self._grouped
+
+
+    def _group_index(self,i,j):
+        if self._group_ids is None:
+            self._group_ids={
+                (pi,pj): g for g,(pi,pj) in enumerate(
+                    self._groups()['points'].tolist()) }
+        return self._group_ids[(int(i),int(j))]
+
+
+    def _groups_data(self,group_ids,summary=False):
+        groups=self._groups()
+        starts=groups['offsets'][group_ids]
+        ends=groups['offsets'][group_ids+1]
+        alerts=[groups['alerts'][s:e] for s,e in zip(starts,ends)]
+        hulls,areas=convex_hulls(
+            np.concatenate(alerts)[:,:-1].astype(int),
+            np.concatenate(([0],np.cumsum(ends-starts))),
+            prefilter=HULL_PREFILTER)
+        return [
+            self._group_data(g,a,hull,area,summary)
+            for g,a,hull,area in zip(group_ids,alerts,hulls,areas)]
+
+
+    def _group_data(self,g,alerts,hull,area,summary=False):
+        groups=self._groups()
+        i,j=groups['points'][g]
+        cluster_dict={
+            'i':int(i),
+            'j':int(j),
+            'count':int(groups['counts'][g]),
+            'area':int(round(area)),
+            'max_date':int(groups['max_dates'][g]),
+            'min_date':int(groups['min_dates'][g]),
+            'hull':hull }
+        if not summary:
+            cluster_dict['alerts']=alerts.astype(int).tolist()
+        return cluster_dict
 
-    def _alerts_for_points(self,i,j):
-        is_in_cluster=np.logical_and(
-            self._joined_data()[:,0]==i,
-            self._joined_data()[:,1]==j)
-        alerts=self._joined_data()[is_in_cluster][:,2:]
-        return alerts
+
+    def _mean_shift(self,cdata,weights):
+        """ shift weighted points
+            
+            Returns:
+                (shifted-points, labels) where labels maps each input point
+                to its row in shifted-points
+        """
+        cdata=self._warm_start(cdata)
+        tolerance=self._tolerance()
+        labels=np.arange(cdata.shape[0])
+        active=np.arange(cdata.shape[0])
+        self.nb_iterations=0
+        for n in range(self.iterations):
+            if not active.shape[0]:
+                break
+            if NOISY: 
+                if (n+1)%5==0: print("...{}/{} [{}]".format(
+                    n+1,self.iterations,active.shape[0]))
+            previous=cdata[active]
+            cdata=self._shift(cdata,weights,active)
+            self.nb_iterations+=1
+            if tolerance is not None:
+                moved=np.sqrt(((cdata[active]-previous)**2).sum(1))
+                active=active[moved>tolerance]
+            if self.merge:
+                cdata,weights,labels,active=self._merge(
+                    cdata,weights,labels,active)
+        return cdata,labels
+
+
+    def _warm_start(self,cdata):
+        """ move points within width of a previous centroid onto it
+        """
+        if (self.centroids is None) or (not len(self.centroids)):
+            return cdata
+        centroids=np.subtract(
+            np.asarray(self.centroids,dtype=float).reshape(-1,2),
+            SHIFT)
+        for start in range(0,cdata.shape[0],self.block_size):
+            end=start+self.block_size
+            dist=np.subtract.outer(cdata[start:end,0],centroids[:,0])**2
+            dist+=np.subtract.outer(cdata[start:end,1],centroids[:,1])**2
+            nearest=np.argmin(dist,axis=1)
+            is_near=dist[np.arange(nearest.shape[0]),nearest]<=self.width**2
+            cdata[start:end][is_near]=centroids[nearest[is_near]]
+        return cdata
+
+
+    def _tolerance(self):
+        if (self.tolerance is None) and (self.centroids is not None):
+            return WARM_TOLERANCE
+        return self.tolerance
+
+
+    def _grid_modes(self):
+        ij=self.ij_data()[:,:2].astype(int)
+        mask=np.zeros((SIZE,SIZE))
+        np.add.at(mask,(ij[:,0],ij[:,1]),1)
+        modes,self.nb_iterations=density.hill_climb(
+            density.density(mask,self.width,self.cutoff))
+        modes=modes[ij[:,0],ij[:,1]]
+        return np.column_stack((modes//SIZE,modes%SIZE))
+
+
+    def _seeded_modes(self):
+        ij=self.ij_data()[:,:2]
+        inverse,counts=self._seed_bins(ij)
+        seeds=np.column_stack((
+            np.bincount(inverse,weights=ij[:,0]),
+            np.bincount(inverse,weights=ij[:,1])))
+        seeds=np.subtract(seeds/np.expand_dims(counts,1),SHIFT)
+        seeds,labels=self._mean_shift(seeds,counts.astype(float))
+        return np.add(seeds[labels],SHIFT).round().astype(int)[inverse]
+
+
+    def _seed_bins(self,ij):
+        """ bin the alerts into at most self.seeds bins
+
+            the bin size is first estimated from the seed budget as
+            ceil(sqrt(nb_alerts/seeds)), and if there are still too many
+            occupied bins it is scaled up once by sqrt(nb_bins/seeds). the
+            bin size is capped at max_size, which fits the bounding box of
+            the alerts into floor(sqrt(seeds))^2 bins.
+
+            Returns:
+                (inverse, counts) bin index of each alert and bin counts
+        """
+        ij=ij-ij.min(axis=0)
+        side=max(int(math.sqrt(self.seeds)),1)
+        max_size=int(ij.max())//side+1
+        bin_size=min(int(math.ceil(math.sqrt(ij.shape[0]/float(self.seeds)))),max_size)
+        for attempt in range(3):
+            _,inverse,counts=np.unique(
+                np.floor_divide(ij,max(bin_size,1)),
+                axis=0,
+                return_inverse=True,
+                return_counts=True)
+            if (counts.shape[0]<=self.seeds) or (bin_size>=max_size):
+                break
+            elif attempt==0:
+                scale=math.sqrt(counts.shape[0]/float(self.seeds))
+                bin_size=min(max(int(math.ceil(bin_size*scale)),bin_size+1),max_size)
+            else:
+                bin_size=max_size
+        return inverse.reshape(-1), counts
+
+
+    def _merge(self,cdata,weights,labels,active):
+        cells=np.round(cdata/self.merge)
+        _,inverse=np.unique(cells,axis=0,return_inverse=True)
+        inverse=inverse.reshape(-1)
+        merged_weights=np.bincount(inverse,weights=weights)
+        merged=np.column_stack((
+            np.bincount(inverse,weights=weights*cdata[:,0]),
+            np.bincount(inverse,weights=weights*cdata[:,1])))
+        merged/=np.expand_dims(merged_weights,1)
+        is_active=np.bincount(
+            inverse[active],
+            minlength=merged_weights.shape[0])>0
+        return merged,merged_weights,inverse[labels],np.nonzero(is_active)[0]
+
+
+    def _shift(self,cdata,weights,active):
+        if self.engine==BLOCK_ENGINE:
+            return self._block_shift(cdata,weights,active)
+        else:
+            return self._loop_shift(cdata,weights,active)
+
+
+    def _loop_shift(self,cdata,weights,active):
+        for i in active:
+            x=cdata[i]
+            dist=np.sqrt(((x-cdata)**2).sum(1))
+            weight=self._gaussian(dist)*weights
+            cdata[i]=(
+                np.expand_dims(weight,1)*cdata).sum(0)/weight.sum()
+        return cdata
+
+
+    def _block_shift(self,cdata,weights,active):
+        shifted=cdata.copy()
+        for block,candidates in self._blocks(cdata,active):
+            points=cdata[candidates]
+            dist=np.subtract.outer(cdata[block,0],points[:,0])**2
+            dist+=np.subtract.outer(cdata[block,1],points[:,1])**2
+            np.sqrt(dist,out=dist)
+            weight=self._gaussian(dist)
+            if self.cutoff:
+                weight[dist>self.cutoff]=0
+            weight*=weights[candidates]
+            shifted[block]=weight.dot(points)/weight.sum(1,keepdims=True)
+        return shifted
+
+
+    def _blocks(self,cdata,active):
+        if self.cutoff:
+            for block in GridIndex(cdata,self.cutoff).blocks(
+                    query=active,
+                    block_size=self.block_size):
+                yield block
+        else:
+            candidates=slice(None)
+            for start in range(0,active.shape[0],self.block_size):
+                yield active[start:start+self.block_size], candidates
 
 
     def _gaussian(self,d):
@@ -0,0 +1,75 @@
+import numpy as np
+
+NEIGHBORS=[(di,dj) for di in (-1,0,1) for dj in (-1,0,1)]
+
+
+class GridIndex(object):
+    """ GridIndex:
+
+        Buckets points into square cells with sides of length cutoff. Every
+        point within cutoff of a given point lies in that point's cell or
+        in one of the 8 cells around it.
+
+        Args:
+            points<arr>: array of [i,j] valued arrays
+            cutoff<float>: cell size/search radius
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,points,cutoff):
+        self.points=points
+        self.cutoff=cutoff
+        self._build()
+
+
+    def blocks(self,query=None,block_size=None):
+        """ group query points by cell
+
+            Args:
+                query<arr>: indices of the points to query (defaults to all points)
+                block_size<int>: if set, split cells into blocks of at most
+                    block_size query points
+
+            Yields:
+                (query-indices, candidate-indices) tuples. candidates are
+                the indices of all points in the 3x3 cells around the block.
+        """
+        if query is None:
+            query=np.arange(self.points.shape[0])
+        qkeys=self.keys[query]
+        order=np.argsort(qkeys,kind='mergesort')
+        qkeys=qkeys[order]
+        query=query[order]
+        ukeys,starts=np.unique(qkeys,return_index=True)
+        ends=np.append(starts[1:],query.shape[0])
+        for key,start,end in zip(ukeys,starts,ends):
+            candidates=self._candidates(key)
+            step=block_size or (end-start)
+            for bstart in range(start,end,step):
+                yield query[bstart:min(bstart+step,end)], candidates
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _build(self):
+        cells=np.floor(self.points/self.cutoff).astype(int)
+        cells-=cells.min(axis=0)
+        self.ncols=cells[:,1].max()+2
+        self.keys=cells[:,0]*self.ncols+cells[:,1]
+        self.order=np.argsort(self.keys,kind='mergesort')
+        ukeys,starts,counts=np.unique(
+            self.keys[self.order],
+            return_index=True,
+            return_counts=True)
+        self.cells=dict(zip(ukeys,zip(starts,starts+counts)))
+
+
+    def _candidates(self,key):
+        slices=[]
+        for di,dj in NEIGHBORS:
+            bounds=self.cells.get(key+di*self.ncols+dj)
+            if bounds:
+                slices.append(self.order[bounds[0]:bounds[1]])
+        return np.concatenate(slices)
@@ -0,0 +1,94 @@
+import base64
+import zlib
+import numpy as np
+
+JSON_ENCODING='json'
+PACKED_ENCODING='packed'
+ENCODINGS=[JSON_ENCODING,PACKED_ENCODING]
+ZLIB_COMPRESSION='zlib'
+COLUMNS=[
+    ('i','<u1'),
+    ('j','<u1'),
+    ('days','<u2')]
+OFFSETS_DTYPE='<u4'
+
+
+def pack(clusters,compression=None):
+    """ pack cluster alerts into little-endian binary columns
+
+        The alerts are removed from each cluster dict and replaced by a
+        single packed dict: base64 strings for the i (uint8), j (uint8)
+        and days (uint16) columns of all the alerts, and the uint32
+        offsets of each cluster's alerts.
+
+        Args:
+            clusters<list>: cluster dicts (see MShift.cluster_data)
+            compression<str>: if 'zlib' compress each column
+
+        Returns:
+            packed alerts dict
+    """
+    alerts=[np.asarray(c.pop('alerts')).reshape(-1,3) for c in clusters]
+    counts=[a.shape[0] for a in alerts]
+    offsets=np.concatenate(([0],np.cumsum(counts))).astype(OFFSETS_DTYPE)
+    if alerts:
+        alerts=np.concatenate(alerts)
+    else:
+        alerts=np.zeros((0,3),dtype=int)
+    packed={
+        'encoding': PACKED_ENCODING,
+        'compression': compression,
+        'offsets': _encode(offsets,compression) }
+    for k,(name,dtype) in enumerate(COLUMNS):
+        packed[name]=_encode(alerts[:,k].astype(dtype),compression)
+    return packed
+
+
+def unpack(packed):
+    """ unpack alerts packed with pack
+
+        The columns are copied once, into a single int array of all of the
+        alerts (use unpack_columns for the columns without a copy).
+
+        Returns:
+            list of [i,j,days] valued arrays, one per cluster. the arrays
+            are views into a single array of all of the alerts.
+    """
+    columns,offsets=unpack_columns(packed)
+    alerts=np.empty((int(offsets[-1]),len(COLUMNS)),dtype=int)
+    for k,(name,_) in enumerate(COLUMNS):
+        alerts[:,k]=columns[name]
+    return [alerts[s:e] for s,e in zip(offsets[:-1],offsets[1:])]
+
+
+def unpack_columns(packed):
+    """ zero-copy unpack of alerts packed with pack
+
+        Returns:
+            (columns, offsets). columns is a dict of read-only np.frombuffer
+            views (i,j: uint8, days: uint16) over the decoded bytes. the
+            alerts of cluster k are at offsets[k]:offsets[k+1].
+    """
+    compression=packed.get('compression')
+    columns={
+        name: _decode(packed[name],dtype,compression) for name,dtype in COLUMNS }
+    offsets=_decode(packed['offsets'],OFFSETS_DTYPE,compression)
+    return columns, offsets
+
+
+def is_packed(alerts):
+    return isinstance(alerts,dict) and (alerts.get('encoding')==PACKED_ENCODING)
+
+
+def _encode(arr,compression):
+    data=arr.tobytes()
+    if compression==ZLIB_COMPRESSION:
+        data=zlib.compress(data)
+    return base64.b64encode(data).decode('ascii')
+
+
+def _decode(data,dtype,compression):
+    data=base64.b64decode(data)
+    if compression==ZLIB_COMPRESSION:
+        data=zlib.decompress(data)
+    return np.frombuffer(data,dtype=dtype)
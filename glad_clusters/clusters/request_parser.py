@@ -9,6 +9,9 @@ DEFAULT_ZOOM=12
 DEFAULT_START_DATE='2015-01-01'
 DEFAULT_DOWNLOAD_FOLDER='/tmp'
 DEFAULT_PREPROCESS_DATA=True
+DEFAULT_ENGINE='loop'
+DEFAULT_BLOCK_SIZE=256
+DEFAULT_ENCODING='json'
 
 #
 #   REQUEST_PARSER
@@ -29,6 +32,20 @@ class RequestParser(object):
         'width',
         'iterations',
         'min_count',
+        'widths',
+        'min_counts',
+        'engine',
+        'block_size',
+        'cutoff',
+        'tolerance',
+        'merge',
+        'seeds',
+        'encoding',
+        'compression',
+        'summary',
+        'fingerprint',
+        'centroids',
+        'tiles_version',
         'csv_bucket',
         'bucket',
         'data_path',
@@ -46,7 +63,18 @@ class RequestParser(object):
         'timestamp',
         'width',
         'iterations',
-        'min_count']
+        'min_count',
+        'widths',
+        'min_counts',
+        'engine',
+        'block_size',
+        'cutoff',
+        'tolerance',
+        'merge',
+        'seeds',
+        'encoding',
+        'compression',
+        'summary']
 
 
     #
@@ -69,6 +97,10 @@ class RequestParser(object):
         return {prop: getattr(self,prop) for prop in self.DATA_PROPERTIES}
 
 
+    def is_sweep(self):
+        return bool(self.widths or self.min_counts)
+
+
     #
     # INTERNAL METHODS
     #
@@ -123,6 +155,18 @@ class RequestParser(object):
             'width': env.int('width'),
             'iterations': env.int('iterations'),
             'min_count': env.int('min_count'),
+            'engine': env.get('engine',default=DEFAULT_ENGINE),
+            'block_size': env.int('block_size',default=DEFAULT_BLOCK_SIZE),
+            'cutoff': env.float('cutoff'),
+            'tolerance': env.float('tolerance'),
+            'merge': env.float('merge'),
+            'seeds': env.int('seeds'),
+            'encoding': env.get('encoding',default=DEFAULT_ENCODING),
+            'compression': env.get('compression',default=None),
+            'summary': env.bool('summary',default=False),
+            'fingerprint': None,
+            'centroids': None,
+            'tiles_version': env.get('tiles_version',default=None),
             'url': env.get('url',default=None),
             'csv_bucket': env.get('csv_bucket',default=None),
             'bucket': env.get('bucket',default=None),
@@ -0,0 +1,236 @@
+import os
+import re
+import uuid
+from collections import OrderedDict
+import numpy as np
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+
+DEFAULT_CACHE_DIR='/tmp/tile_cache'
+MAX_BYTES=2**28
+MAX_DISK_BYTES=2**28
+HEAD_TIMEOUT=10
+VERSION_HEADERS=['ETag','Last-Modified']
+EXT='npy'
+
+
+def source_version(path):
+    """ version of the tile source
+
+        local files are versioned by their mtime and size, http(s) urls by
+        the ETag (or Last-Modified) header of a HEAD request.
+
+        Args:
+            path<str>: tile path or url
+
+        Returns:
+            version string, or None if the source can not be versioned
+    """
+    try:
+        if re.match(r'https?://',path or ''):
+            return _url_version(path)
+        elif path and os.path.isfile(path):
+            stat=os.stat(path)
+            return '{}-{}'.format(int(stat.st_mtime*1e6),stat.st_size)
+    except Exception:
+        pass
+    return None
+
+
+class DecodedTileCache(object):
+    """ DecodedTileCache:
+
+        Two-tier cache of decoded tile arrays keyed by z/x/y and source
+        version. The first tier is an in-memory LRU holding at most
+        max_bytes of arrays, the second a directory of .npy files that
+        are memory-mapped when read. Writing a new version of a tile
+        removes the older versions, and the least recently used files are
+        removed when the directory passes max_disk_bytes. The size of the
+        directory is kept as a running total (read once, and re-read
+        whenever files are evicted).
+
+        Cached arrays are read-only.
+
+        Args:
+            cache_dir<str>: directory for the .npy files (None for memory only)
+            max_bytes<int>: in-memory budget in bytes
+            max_disk_bytes<int>: on-disk budget in bytes
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            cache_dir=DEFAULT_CACHE_DIR,
+            max_bytes=MAX_BYTES,
+            max_disk_bytes=MAX_DISK_BYTES):
+        self.cache_dir=cache_dir
+        self.max_bytes=max_bytes
+        self.max_disk_bytes=max_disk_bytes
+        self.nb_bytes=0
+        self.nb_disk_bytes=None
+        self.stats={
+            'nb_memory_hits': 0,
+            'nb_disk_hits': 0,
+            'nb_misses': 0 }
+        self._arrays=OrderedDict()
+
+
+    def get(self,z,x,y,load,version=None):
+        """ decoded tile
+
+            Args:
+                z,x,y<int,int,int>: tile
+                load<func>: returns the decoded tile array on a cache miss
+                version<str>: source version (see source_version). if None
+                    the tile is loaded and not cached
+        """
+        if version is None:
+            self.stats['nb_misses']+=1
+            return load()
+        key=(int(z),int(x),int(y),_safe_version(version))
+        arr=self._arrays.pop(key,None)
+        if arr is not None:
+            self._arrays[key]=arr
+            self.stats['nb_memory_hits']+=1
+            return arr
+        arr=self._read(key)
+        if arr is None:
+            self.stats['nb_misses']+=1
+            arr=np.asarray(load())
+            self._write(key,arr)
+            arr.flags.writeable=False
+        else:
+            self.stats['nb_disk_hits']+=1
+        self._keep(key,arr)
+        return arr
+
+
+    def clear(self,disk=False):
+        """ empty the in-memory tier (and the on-disk tier if disk)
+        """
+        self._arrays=OrderedDict()
+        self.nb_bytes=0
+        if disk:
+            for path,_,_ in self._files():
+                _remove(path)
+            self.nb_disk_bytes=0
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _keep(self,key,arr):
+        if arr.nbytes<=self.max_bytes:
+            self._arrays[key]=arr
+            self.nb_bytes+=arr.nbytes
+            while self.nb_bytes>self.max_bytes:
+                _,evicted=self._arrays.popitem(last=False)
+                self.nb_bytes-=evicted.nbytes
+
+
+    def _read(self,key):
+        if self.cache_dir:
+            path=self._path(key)
+            if os.path.isfile(path):
+                try:
+                    arr=np.load(path,mmap_mode='r')
+                    os.utime(path,None)
+                    return arr
+                except Exception:
+                    size=_remove(path)
+                    if self.nb_disk_bytes is not None:
+                        self.nb_disk_bytes-=size
+        return None
+
+
+    def _write(self,key,arr):
+        """ write atomically (tmp file + rename) and drop other versions
+        """
+        if self.cache_dir:
+            path=self._path(key)
+            dirname=os.path.dirname(path)
+            try:
+                if self.nb_disk_bytes is None:
+                    self.nb_disk_bytes=sum([f[1] for f in self._files()])
+                if not os.path.isdir(dirname):
+                    os.makedirs(dirname)
+                for name in os.listdir(dirname):
+                    self.nb_disk_bytes-=_remove(os.path.join(dirname,name))
+                tmp_path='{}.{}.tmp'.format(path,uuid.uuid4().hex)
+                with open(tmp_path,'wb') as file:
+                    np.save(file,arr)
+                os.rename(tmp_path,path)
+                self.nb_disk_bytes+=os.path.getsize(path)
+                if self.nb_disk_bytes>self.max_disk_bytes:
+                    self._evict(path)
+            except (IOError,OSError):
+                pass
+
+
+    def _evict(self,keep_path):
+        files=sorted(self._files(),key=lambda f: f[2])
+        size=sum([f[1] for f in files])
+        for path,file_size,_ in files:
+            if size<=self.max_disk_bytes:
+                break
+            if path!=keep_path:
+                size-=_remove(path)
+        self.nb_disk_bytes=size
+
+
+    def _files(self):
+        """ (path, size, mtime) of the cached files
+        """
+        files=[]
+        if self.cache_dir and os.path.isdir(self.cache_dir):
+            for root,_,names in os.walk(self.cache_dir):
+                for name in names:
+                    path=os.path.join(root,name)
+                    try:
+                        stat=os.stat(path)
+                        files.append((path,stat.st_size,stat.st_mtime))
+                    except OSError:
+                        pass
+        return files
+
+
+    def _path(self,key):
+        z,x,y,version=key
+        return os.path.join(
+            self.cache_dir,
+            str(z),str(x),str(y),
+            '{}.{}'.format(version,EXT))
+
+
+
+
+def _url_version(url):
+    request=Request(url)
+    request.get_method=lambda: 'HEAD'
+    response=urlopen(request,timeout=HEAD_TIMEOUT)
+    try:
+        headers=response.info()
+        for header in VERSION_HEADERS:
+            if headers.get(header):
+                return headers.get(header)
+    finally:
+        response.close()
+    return None
+
+
+def _safe_version(version):
+    return re.sub(r'[^A-Za-z0-9_.-]','_','{}'.format(version))
+
+
+def _remove(path):
+    """ remove path (if it exists). returns the bytes removed
+    """
+    try:
+        size=os.path.getsize(path)
+        os.remove(path)
+        return size
+    except OSError:
+        return 0
@@ -1,5 +1,9 @@
 from os import environ
-import __builtin__
+
+try:
+  import __builtin__
+except ImportError:
+  import builtins as __builtin__
 
 try:
   basestring
@@ -1,17 +1,30 @@
 from __future__ import print_function
 import json
+import hashlib
+import os
 import logging
+import boto3
 import imageio as io
 from clusters.meanshift import MShift
 from clusters.request_parser import RequestParser
-import clusters.processors as proc
-from datetime import datetime, timedelta
+import clusters.dates as dates
+import clusters.payload as payload
+from clusters.tile_cache import DecodedTileCache
+from clusters.tile_cache import source_version
 import numpy as np
 
 #
 # CONFIG
 #
-RETURN_EMPTY=False
+EMPTY_STATUS='empty'
+UNCHANGED_STATUS='unchanged'
+FINGERPRINT_PROPERTIES=[
+    'z', 'x', 'y',
+    'width', 'iterations', 'min_count', 'widths', 'min_counts',
+    'engine', 'block_size', 'cutoff', 'tolerance', 'merge', 'seeds',
+    'summary']
+TILE_CACHE_DIR = '/tmp/tile_cache'
+TILE_CACHE_BYTES = 2**28
 
 
 #
@@ -23,6 +36,12 @@ logger=logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
+#
+# TILE CACHE (kept by warm containers)
+#
+TILE_CACHE = DecodedTileCache(TILE_CACHE_DIR, TILE_CACHE_BYTES)
+
+
 ## Processor Functions
 
 def glad_between_dates(
@@ -47,17 +66,9 @@ def glad_between_dates(
             with 1 if an alert exists between the dates, otherwise 0.
 
     """
-    DATE_STR_FMT = '%Y-%m-%d'
-    INT_DATE_FMT = '%Y%m%d'
-    if image_type == "FORMA":
-        GLAD_START_DATE = datetime.strptime('2012-01-01', DATE_STR_FMT)
-    elif image_type == "GLAD":
-        GLAD_START_DATE = datetime.strptime('2015-01-01', DATE_STR_FMT)
-    else:
-        GLAD_START_DATE = datetime.strptime('2015-01-01', DATE_STR_FMT)
-
     intensity, days = _get_intensity_days(data)
-    is_between_dates = _days_are_between_dates(days, start_date, end_date)
+    is_between_dates = _days_are_between_dates(
+        days, start_date, end_date, image_type)
     if return_days:
         if return_intensity:
             bands = [_between_dates(is_between_dates, intensity),
@@ -72,24 +83,48 @@ def glad_between_dates(
     return im
 
 
-def date_for_days(days):
-    date = (GLAD_START_DATE + timedelta(days=days))
-    return int(date.strftime(INT_DATE_FMT))
+def glad_alerts(data, start_date, end_date, image_type=None):
+    """ sparse glad alerts between dates
+
+        Fused decode of the days bands: only the two uint8 days bands are
+        read, in integer arithmetic, and the alerts are returned directly
+        as a sparse list rather than as a dense filtered image.
+
+        Args:
+            data<arr>: glad image
+            start_date<str>: yyyy-mm-dd
+            end_date<str>: yyyy-mm-dd
+
+        Returns:
+            array of [i,j,days-since] valued arrays
+    """
+    start_days = max(_days_since_start(start_date, image_type), 1)
+    end_days = _days_since_start(end_date, image_type)
+    days = data[:, :, 0].astype(np.int32)
+    days *= 255
+    days += data[:, :, 1]
+    i, j = np.nonzero((days >= start_days) & (days < end_days))
+    return np.column_stack((i, j, days[i, j]))
+
+
+def date_for_days(days, image_type=None):
+    return dates.days_to_int(days, image_type)
 
 
 def _between_dates(is_between_dates, im):
     return np.where(is_between_dates, im, 0)
 
 
-def _days_are_between_dates(days, start_date, end_date):
-    start_days = _days_since_glad_start(start_date)
-    end_days = _days_since_glad_start(end_date)
+def _days_are_between_dates(days, start_date, end_date, image_type=None):
+    start_days = _days_since_start(start_date, image_type)
+    end_days = _days_since_start(end_date, image_type)
     return np.logical_and(days >= start_days, days < end_days)
 
 
-def _days_since_glad_start(date_str):
-    date = datetime.strptime(date_str, DATE_STR_FMT)
-    return (date - GLAD_START_DATE).days
+def _days_since_start(date_str, image_type=None):
+    """ days since the GLAD (or FORMA) epoch (see dates.str_to_days)
+    """
+    return int(dates.str_to_days(date_str, image_type))
 
 
 def _get_intensity_days(data):
@@ -109,43 +144,139 @@ def meanshift(event, context, image_type=None):
             if im_data is False:
                 return _error(req, '{} not found'.format(req.data_path), 2)
             else:
-                im_data = glad_between_dates(
+                alerts = glad_alerts(
                     im_data,
                     req.start_date,
-                    req.end_date, image_type)
+                    req.end_date,
+                    image_type)
+                nb_alerts = alerts.shape[0]
+                fingerprint = _fingerprint(req, alerts, image_type)
+                if req.fingerprint and (req.fingerprint == fingerprint):
+                    return _status(req, UNCHANGED_STATUS, nb_alerts, fingerprint)
+                if nb_alerts < _min_count(req):
+                    return _status(req, EMPTY_STATUS, nb_alerts, fingerprint)
 
                 mshift = MShift(
-                    data=im_data,
+                    alerts=alerts,
                     width=req.width,
                     min_count=req.min_count,
-                    iterations=req.iterations)
+                    iterations=req.iterations,
+                    engine=req.engine,
+                    block_size=req.block_size,
+                    cutoff=req.cutoff,
+                    tolerance=req.tolerance,
+                    merge=req.merge,
+                    seeds=req.seeds,
+                    centroids=req.centroids,
+                    image_type=image_type)
                 output_data, nb_clusters = _output_data(req, mshift)
-                if (nb_clusters > 0) or RETURN_EMPTY:
+                output_data['nb_alerts'] = nb_alerts
+                output_data['fingerprint'] = fingerprint
+                if nb_clusters > 0:
                     return output_data
                 else:
-                    return None
+                    return _status(req, None, nb_alerts, fingerprint)
         except Exception as e:
             return _error(req, 'Exception: {}'.format(e), 3)
 
 
 def _im_data(req):
-    if not req.url: _download(req.bucket, req.file_name, req.data_path)
+    """ decoded tile, from TILE_CACHE if the tile version is cached
+    """
     try:
-        return io.imread(req.data_path)
+        return TILE_CACHE.get(
+            req.z, req.x, req.y,
+            lambda: _read_image(req),
+            _tile_version(req))
     except Exception as e:
         logger.warn(
             "\nfailed to read image ({}) -- {}".format(req.data_path, e))
         return False
 
 
+def _tile_version(req):
+    """ version of the tile source: tiles_version if set, else the ETag
+        of the s3 object (or url), or the mtime of a local file
+    """
+    if req.tiles_version:
+        return req.tiles_version
+    elif req.url:
+        return source_version(req.data_path)
+    else:
+        try:
+            return _s3_client().head_object(
+                Bucket=req.bucket,
+                Key=req.file_name).get('ETag')
+        except Exception as e:
+            logger.warn(
+                "\nfailed to version tile ({}) -- {}".format(req.file_name, e))
+            return None
+
+
+def _read_image(req):
+    if not req.url: _download(req.bucket, req.file_name, req.data_path)
+    return io.imread(req.data_path)
+
+
 def _output_data(req, mshift):
     data = req.data()
-    data['data'] = mshift.clusters_data() or {}
-    nb_clusters = data['data'].pop('nb_clusters', 0)
+    if req.is_sweep():
+        sweep = mshift.sweep(
+            req.widths or [req.width],
+            req.min_counts or [req.min_count],
+            req.summary)
+        nb_clusters = sum([s.pop('nb_clusters', 0) for s in sweep])
+        data['data'] = {'sweep': sweep}
+    else:
+        data['data'] = mshift.clusters_data(summary=req.summary) or {}
+        nb_clusters = data['data'].pop('nb_clusters', 0)
+    if (req.encoding == payload.PACKED_ENCODING) and (not req.summary):
+        for result in data['data'].get('sweep', [data['data']]):
+            result['alerts'] = payload.pack(
+                result.get('clusters', []),
+                req.compression)
     data['nb_clusters'] = nb_clusters
     return data, nb_clusters
 
 
+def _min_count(req):
+    """ smallest min_count requested (at least 1)
+    """
+    min_counts = [m for m in (req.min_counts or [req.min_count]) if m]
+    if min_counts:
+        return max(min(min_counts), 1)
+    else:
+        return 1
+
+
+def _fingerprint(req, alerts, image_type=None):
+    """ hash of the filtered alerts and the clustering params
+
+        Tiles with the same fingerprint have the same clusters, so a
+        request carrying the previous run's fingerprint for the tile
+        can skip clustering when nothing changed.
+    """
+    params = [getattr(req, prop) for prop in FINGERPRINT_PROPERTIES]
+    digest = hashlib.sha1(json.dumps(params + [image_type]).encode('utf-8'))
+    digest.update(np.ascontiguousarray(alerts, dtype=np.int32).tobytes())
+    return digest.hexdigest()
+
+
+def _status(req, status, nb_alerts, fingerprint):
+    """ minimal response for tiles without clusters to return: too few
+        alerts to cluster (empty), an unchanged fingerprint (unchanged)
+        or no clusters found (status None)
+    """
+    response = {
+        'nb_alerts': nb_alerts,
+        'nb_clusters': 0,
+        'fingerprint': fingerprint}
+    if status:
+        response['status'] = status
+    response.update(req.data())
+    return response
+
+
 def _error(req, msg, trace_id):
     error = {'error': msg, 'error_trace': 'handler.{}'.format(trace_id)}
     error.update(req.data())
@@ -165,9 +296,19 @@ def _process_response(event, output_data):
     return response
 
 
-def _download(self, bucket, file, download_path):
-    client = boto3.resource('s3').meta.client
-    return client.download_file(bucket, file, download_path)
+def _download(bucket, file, download_path):
+    dirname = os.path.dirname(download_path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    return _s3_client().download_file(bucket, file, download_path)
+
+
+_S3_CLIENT = None
+def _s3_client():
+    global _S3_CLIENT
+    if _S3_CLIENT is None:
+        _S3_CLIENT = boto3.client('s3')
+    return _S3_CLIENT
 
 
 #
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import multiprocessing
+import boto3
+from boto3.session import Config
+import glad_clusters.utils.multiprocess as mp
+
+
+LAMBDA_BACKEND='lambda'
+LOCAL_BACKEND='local'
+ASYNC_BACKEND='async'
+BACKENDS=[LAMBDA_BACKEND,LOCAL_BACKEND,ASYNC_BACKEND]
+LAMBDA_FUNCTION_NAME='gfw-glad-clusters-v1-dev-meanshift'
+BOTO3_CONFIG={
+    'read_timeout': 600,
+    'region_name': 'us-east-1'
+}
+HANDLER_DIR=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def get_backend(backend=LAMBDA_BACKEND,tiles_dir=None):
+    """ backend instance from a backend name (or instance)
+
+        Args:
+            backend<str|backend>: 'lambda', 'local', 'async' or a backend instance
+            tiles_dir<str>: local tile directory for the 'local' backend
+    """
+    if backend==LAMBDA_BACKEND:
+        return LambdaBackend()
+    elif backend==LOCAL_BACKEND:
+        return LocalBackend(tiles_dir=tiles_dir)
+    elif backend==ASYNC_BACKEND:
+        return AsyncLambdaBackend()
+    elif isinstance(backend,str):
+        raise ValueError('backend must be one of {}'.format(BACKENDS))
+    else:
+        return backend
+
+
+class Backend(object):
+    """ Backend:
+
+        Runs the meanshift handler for ClusterService requests.
+        Subclasses implement invoke and map, and keep per-instance
+        run stats in .stats
+    """
+    def __init__(self):
+        self.stats={}
+
+
+    def invoke(self,request):
+        """ run a single request
+
+            Args:
+                request<dict>: request data (see ClusterService._request_data)
+
+            Returns:
+                the (json-decoded) handler response
+        """
+        raise NotImplementedError
+
+
+    def map(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        """ run a list of requests
+
+            Args:
+                requests<list>: request dicts
+                max_processes<int>: max concurrency
+                hedge_percentile,hedge_budget: straggler hedging (see
+                    utils.invoker.AsyncInvoker). only supported by the
+                    async backend.
+
+            Returns:
+                list of (response, error) tuples. error is None unless
+                invoke raised.
+        """
+        raise NotImplementedError
+
+
+    def imap(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        """ run a list of requests, yielding results as they complete
+
+            Args: see map
+
+            Yields:
+                (index, response, error) tuples in completion order. index
+                is the position of the request in requests.
+        """
+        raise NotImplementedError
+
+
+    def safe_invoke(self,request):
+        return _safe_invoke(self.invoke,request)
+
+
+    def indexed_safe_invoke(self,indexed_request):
+        index,request=indexed_request
+        return (index,)+self.safe_invoke(request)
+
+
+    def _check_hedging(self,hedge_percentile):
+        if hedge_percentile is not None:
+            raise ValueError('hedging requires the {} backend'.format(ASYNC_BACKEND))
+
+
+
+
+class LambdaBackend(Backend):
+    """ LambdaBackend:
+
+        Invokes the meanshift lambda function. Requests are run on a
+        threadpool.
+
+        Args:
+            function_name<str>: lambda function name
+            config<dict>: boto3 client config
+            endpoint_url<str>: lambda endpoint (e.g. a local stub)
+    """
+    def __init__(self,
+            function_name=LAMBDA_FUNCTION_NAME,
+            config=BOTO3_CONFIG,
+            endpoint_url=None):
+        Backend.__init__(self)
+        self.function_name=function_name
+        self.config=config
+        self.endpoint_url=endpoint_url
+        self._client=None
+
+
+    def invoke(self,request):
+        response=self.client().invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=json.dumps(request))
+        return json.loads(response.get('Payload',{}).read())
+
+
+    def map(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        self._check_hedging(hedge_percentile)
+        return mp.map_with_threadpool(
+            self.safe_invoke,
+            requests,
+            max_processes=max_processes)
+
+
+    def imap(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        self._check_hedging(hedge_percentile)
+        return mp.imap_with_threadpool(
+            self.indexed_safe_invoke,
+            list(enumerate(requests)),
+            max_processes=max_processes)
+
+
+    def client(self):
+        if self._client is None:
+            self._client=boto3.client(
+                'lambda',
+                endpoint_url=self.endpoint_url,
+                config=Config(**self.config))
+        return self._client
+
+
+
+
+class AsyncLambdaBackend(LambdaBackend):
+    """ AsyncLambdaBackend:
+
+        LambdaBackend that maps requests with utils.invoker.AsyncInvoker
+        (python 3): an adaptive in-flight window, jittered retries and a
+        per-request deadline in place of a fixed threadpool. The invoker
+        stats for the last map are kept in .stats
+
+        Args:
+            function_name,config,endpoint_url: see LambdaBackend
+            invoke<func>: replaces the lambda invoke (see AsyncInvoker)
+            **invoker_kwargs: AsyncInvoker window/retry/deadline args
+    """
+    def __init__(self,
+            function_name=LAMBDA_FUNCTION_NAME,
+            config=BOTO3_CONFIG,
+            endpoint_url=None,
+            invoke=None,
+            **invoker_kwargs):
+        LambdaBackend.__init__(self,function_name,config,endpoint_url)
+        self.invoke_func=invoke
+        self.invoker_kwargs=invoker_kwargs
+
+
+    def invoke(self,request):
+        if self.invoke_func:
+            return self.invoke_func(request)
+        return LambdaBackend.invoke(self,request)
+
+
+    def map(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        invoker=self._invoker(max_processes,hedge_percentile,hedge_budget)
+        results=invoker.run(requests)
+        self.stats=invoker.stats
+        return results
+
+
+    def imap(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        invoker=self._invoker(max_processes,hedge_percentile,hedge_budget)
+        self.stats=invoker.stats
+        for result in invoker.imap(requests):
+            yield result
+        self.stats=invoker.stats
+
+
+    def _invoker(self,max_processes,hedge_percentile,hedge_budget):
+        from glad_clusters.utils.invoker import AsyncInvoker
+        invoker_kwargs=dict({'max_window': max_processes},**self.invoker_kwargs)
+        if hedge_percentile is not None:
+            invoker_kwargs['hedge_percentile']=hedge_percentile
+        if hedge_budget is not None:
+            invoker_kwargs['hedge_budget']=hedge_budget
+        return AsyncInvoker(
+            invoke=self.invoke_func,
+            endpoint_url=self.endpoint_url,
+            function_name=self.function_name,
+            config=self.config,
+            **invoker_kwargs)
+
+
+
+
+class LocalBackend(Backend):
+    """ LocalBackend:
+
+        Calls the handler's meanshift directly, on a process pool, with
+        tiles read from a local directory laid out as {tiles_dir}/{z}/{x}/{y}.png.
+
+        Args:
+            tiles_dir<str>: local tile directory (defaults to environ['tiles_dir'])
+            max_processes<int>: max pool size (defaults to the number of cores)
+    """
+    def __init__(self,tiles_dir=None,max_processes=None):
+        Backend.__init__(self)
+        self.tiles_dir=tiles_dir or os.environ.get('tiles_dir')
+        self.max_processes=max_processes or multiprocessing.cpu_count()
+
+
+    def invoke(self,request):
+        return _local_invoke(self._local_request(request))
+
+
+    def map(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        self._check_hedging(hedge_percentile)
+        return mp.map_with_pool(
+            _safe_local_invoke,
+            [self._local_request(r) for r in requests],
+            max_processes=min(max_processes,self.max_processes))
+
+
+    def imap(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        self._check_hedging(hedge_percentile)
+        return mp.imap_with_pool(
+            _indexed_safe_local_invoke,
+            [(index,self._local_request(r)) for index,r in enumerate(requests)],
+            max_processes=min(max_processes,self.max_processes))
+
+
+    def _local_request(self,request):
+        request=dict(request)
+        if self.tiles_dir:
+            request['url']=self.tiles_dir
+        return request
+
+
+
+
+def _handler():
+    """ import handler_new as it is deployed (with clusters/ top-level)
+    """
+    if HANDLER_DIR not in sys.path:
+        sys.path.insert(0,HANDLER_DIR)
+    import handler_new
+    return handler_new
+
+
+def _local_invoke(request):
+    return _handler().meanshift(request,None)
+
+
+def _safe_local_invoke(request):
+    return _safe_invoke(_local_invoke,request)
+
+
+def _indexed_safe_local_invoke(indexed_request):
+    index,request=indexed_request
+    return (index,)+_safe_local_invoke(request)
+
+
+def _safe_invoke(invoke,request):
+    try:
+        return invoke(request), None
+    except Exception as e:
+        return None, "{}".format(e)
@@ -0,0 +1,376 @@
+import os
+import time
+import sqlite3
+import threading
+import glad_clusters.utils.multiprocess as mp
+from glad_clusters.utils.backends import Backend
+from glad_clusters.utils.journal import params_key
+from glad_clusters.utils.journal import encode_response
+from glad_clusters.utils.journal import decode_response
+from glad_clusters.utils.journal import UNCHANGED_STATUS
+from glad_clusters.clusters.tile_cache import source_version
+
+
+MAX_SIZE=2**30
+TILE_PATH_TMPL='{}/{}/{}/{}.png'
+VERSION_PROCESSES=32
+SCHEMA="""
+    CREATE TABLE IF NOT EXISTS results (
+        key TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        accessed REAL NOT NULL,
+        response BLOB NOT NULL)
+"""
+
+
+_CACHES={}
+_CACHES_LOCK=threading.Lock()
+
+
+def get_cache(path,max_size=MAX_SIZE):
+    """ the TileCache for path, shared by everything in the process (so
+        that concurrent requests for a key from different services are
+        deduplicated)
+    """
+    with _CACHES_LOCK:
+        cache=_CACHES.get(path)
+        if cache is None:
+            cache=TileCache(path,max_size)
+            _CACHES[path]=cache
+        cache.max_size=max_size
+        return cache
+
+
+class TileCache(object):
+    """ TileCache:
+
+        Persistent cache of tile responses in a sqlite file. Responses are
+        stored as zlib compressed json, keyed by a hash of the request and
+        the version of the tile's source (see key). When the stored
+        responses pass max_size bytes the least recently used are evicted.
+
+        Requests for a key that is already being invoked (by another thread,
+        or earlier in the same map) wait for that invoke instead of
+        invoking again (see claim/release). Use get_cache to share a cache,
+        and the in-flight requests, between services.
+
+        Args:
+            path<str>: sqlite file path
+            max_size<int>: max bytes of stored responses
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,path,max_size=MAX_SIZE):
+        self.path=path
+        self.max_size=max_size
+        self._conn=None
+        self._lock=threading.RLock()
+        self._in_flight={}
+
+
+    def key(self,request,version):
+        """ key for a request dict (z,x,y, dates, params and fingerprint)
+            and the version of its tile
+
+            Args:
+                request<dict>: request data (see ClusterService._request_data)
+                version<str>: tile source version (see source_version)
+        """
+        return params_key(dict(request,tile_version=version))
+
+
+    def get(self,key):
+        """ cached response (or None) for key
+        """
+        with self._lock:
+            row=self._connection().execute(
+                'SELECT response FROM results WHERE key=?',
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection().execute(
+                'UPDATE results SET accessed=? WHERE key=?',
+                (time.time(),key))
+            self._connection().commit()
+        return decode_response(row[0])
+
+
+    def put(self,key,response):
+        """ store response and evict least recently used responses
+        """
+        data=encode_response(response)
+        with self._lock:
+            self._connection().execute(
+                'INSERT OR REPLACE INTO results VALUES (?,?,?,?)',
+                (key,len(data),time.time(),data))
+            self._evict()
+            self._connection().commit()
+
+
+    def claim(self,key):
+        """ claim an invoke for key
+
+            Returns:
+                (in_flight, owner). if owner the caller must invoke and then
+                call release. otherwise in_flight.result() waits for the
+                (response, error) of the invoke in flight.
+        """
+        with self._lock:
+            in_flight=self._in_flight.get(key)
+            if in_flight is not None:
+                return in_flight, False
+            in_flight=InFlight()
+            self._in_flight[key]=in_flight
+            return in_flight, True
+
+
+    def release(self,key,response=None,error=None):
+        """ store the result of a claimed invoke (if cacheable) and pass it
+            to the requests waiting on it
+        """
+        try:
+            if is_cacheable(response,error):
+                self.put(key,response)
+        finally:
+            with self._lock:
+                in_flight=self._in_flight.pop(key,None)
+            if in_flight is not None:
+                in_flight.set_result((response,error))
+
+
+    def size(self):
+        """ bytes of stored responses
+        """
+        with self._lock:
+            size=self._connection().execute(
+                'SELECT SUM(size) FROM results').fetchone()[0]
+        return size or 0
+
+
+    def clear(self):
+        with self._lock:
+            self._connection().execute('DELETE FROM results')
+            self._connection().commit()
+
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn=None
+
+
+    #
+    # INTERNAL METHODS
+    #
+    def _connection(self):
+        if self._conn is None:
+            dirname=os.path.dirname(self.path)
+            if dirname and not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._conn=sqlite3.connect(self.path,check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute(SCHEMA)
+            self._conn.commit()
+        return self._conn
+
+
+    def _evict(self):
+        size=self._connection().execute(
+            'SELECT SUM(size) FROM results').fetchone()[0] or 0
+        if size>self.max_size:
+            rows=self._connection().execute(
+                'SELECT key,size FROM results ORDER BY accessed').fetchall()
+            evicted=[]
+            for key,row_size in rows:
+                if size<=self.max_size:
+                    break
+                evicted.append((key,))
+                size-=row_size
+            self._connection().executemany(
+                'DELETE FROM results WHERE key=?',
+                evicted)
+
+
+
+
+class InFlight(object):
+    """ result slot for an invoke in flight
+    """
+    def __init__(self):
+        self._event=threading.Event()
+        self._result=None
+
+
+    def set_result(self,result):
+        self._result=result
+        self._event.set()
+
+
+    def result(self):
+        self._event.wait()
+        return self._result
+
+
+
+
+class CachedBackend(Backend):
+    """ CachedBackend:
+
+        Wraps a backend with a TileCache. Each request is keyed with the
+        version of its tile (see source_version): the mtime of the file in
+        the backend's tiles_dir, else the ETag of the tile at tiles_url.
+        Cached tiles are returned without invoking the backend, the rest are
+        invoked (once per key) and the successful responses are cached. Error
+        and 'unchanged' responses, and tiles that can not be versioned, are
+        not cached. Counts for the cache are kept in .cache_stats
+
+        Args:
+            backend<Backend>: backend used for cache misses
+            cache<TileCache>: tile cache
+            tiles_url<str>: tile source for backends without a tiles_dir
+    """
+    def __init__(self,backend,cache,tiles_url=None):
+        self.backend=backend
+        self.cache=cache
+        self.tiles_source=getattr(backend,'tiles_dir',None) or tiles_url
+        self.reset_cache_stats()
+
+
+    @property
+    def stats(self):
+        return self.backend.stats
+
+
+    def reset_cache_stats(self):
+        self.cache_stats={
+            'nb_cache_hits': 0,
+            'nb_cache_misses': 0,
+            'nb_cache_dedups': 0,
+            'nb_cache_unversioned': 0 }
+
+
+    def version(self,request):
+        """ source version of the request's tile (None if unknown)
+        """
+        if self.tiles_source:
+            return source_version(TILE_PATH_TMPL.format(
+                self.tiles_source,
+                request['z'],request['x'],request['y']))
+        return None
+
+
+    def invoke(self,request):
+        key=self._key(request,self.version(request))
+        if key is None:
+            return self.backend.invoke(request)
+        response=self._get(key)
+        if response is not None:
+            return response
+        in_flight,owner=self._claim(key)
+        if owner:
+            response,error=None,None
+            try:
+                response=self.backend.invoke(request)
+            except Exception as e:
+                error="{}".format(e)
+                raise
+            finally:
+                self.cache.release(key,response,error)
+        else:
+            response,error=in_flight.result()
+            if error:
+                raise Exception(error)
+        return response
+
+
+    def map(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        requests=list(requests)
+        results=[None]*len(requests)
+        for index,response,error in self.imap(
+                requests,
+                max_processes,
+                hedge_percentile=hedge_percentile,
+                hedge_budget=hedge_budget):
+            results[index]=(response,error)
+        return results
+
+
+    def imap(self,requests,max_processes,hedge_percentile=None,hedge_budget=None):
+        requests=list(requests)
+        if not requests:
+            return
+        versions=mp.map_with_threadpool(
+            self.version,
+            requests,
+            max_processes=min(max_processes,VERSION_PROCESSES))
+        keys=[self._key(r,v) for r,v in zip(requests,versions)]
+        misses,waiting=[],[]
+        for index,key in enumerate(keys):
+            response=(key is not None) and self._get(key)
+            if response:
+                yield index, response, None
+            elif key is None:
+                misses.append(index)
+            else:
+                in_flight,owner=self._claim(key)
+                if owner:
+                    misses.append(index)
+                else:
+                    waiting.append((index,in_flight))
+        released=set()
+        try:
+            if misses:
+                results=self.backend.imap(
+                    [requests[index] for index in misses],
+                    max_processes,
+                    hedge_percentile=hedge_percentile,
+                    hedge_budget=hedge_budget)
+                for k,response,error in results:
+                    index=misses[k]
+                    if keys[index] is not None:
+                        self.cache.release(keys[index],response,error)
+                    released.add(index)
+                    yield index, response, error
+        finally:
+            for index in misses:
+                if (index not in released) and (keys[index] is not None):
+                    self.cache.release(keys[index],None,'cancelled')
+        for index,in_flight in waiting:
+            yield (index,)+in_flight.result()
+
+
+    def _key(self,request,version):
+        if version is None:
+            self.cache_stats['nb_cache_unversioned']+=1
+            return None
+        return self.cache.key(request,version)
+
+
+    def _get(self,key):
+        response=self.cache.get(key)
+        if response is None:
+            self.cache_stats['nb_cache_misses']+=1
+        else:
+            self.cache_stats['nb_cache_hits']+=1
+        return response
+
+
+    def _claim(self,key):
+        in_flight,owner=self.cache.claim(key)
+        if not owner:
+            self.cache_stats['nb_cache_dedups']+=1
+        return in_flight, owner
+
+
+
+
+def is_cacheable(response,error=None):
+    """ true for responses without errors that do not depend on a previous run
+    """
+    return bool(
+        response and (not error) and
+        (not (response.get('error') or response.get('errorMessage'))) and
+        (response.get('status')!=UNCHANGED_STATUS))
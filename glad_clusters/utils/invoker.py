@@ -0,0 +1,400 @@
+import asyncio
+import json
+import math
+import queue
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from boto3.session import Config
+from glad_clusters.utils.backends import LAMBDA_FUNCTION_NAME
+from glad_clusters.utils.backends import BOTO3_CONFIG
+
+
+WINDOW=16
+MIN_WINDOW=1
+MAX_WINDOW=200
+RETRIES=5
+BACKOFF=0.5
+MAX_BACKOFF=30
+DEADLINE=900
+HEDGE_BUDGET=0.05
+MIN_HEDGE_SAMPLES=20
+HEDGE_POLL=0.1
+THROTTLE_CODES=[
+    'TooManyRequestsException',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestLimitExceeded']
+
+
+class ThrottleError(Exception):
+    """ raise from an injected invoke to signal a throttling response
+    """
+    pass
+
+
+class AsyncInvoker(object):
+    """ AsyncInvoker:
+
+        Invokes lambda for a list of requests from an asyncio event loop.
+
+        * at most `window` requests are in flight. the window grows by
+          one for every window's worth of successes and is halved on
+          throttling (AIMD), at most once per `backoff` seconds.
+        * failed attempts are retried after a jittered exponential backoff
+          (uniform in [0, min(max_backoff, backoff*2^attempt)]). a request
+          holds no slot while it backs off.
+        * each request (including its retries) must finish within
+          `deadline` seconds.
+        * hedging (if hedge_percentile is set): an attempt still in flight
+          after the hedge_percentile latency of the completed attempts is
+          re-issued once, if there is a free slot in the window and hedge
+          budget left. the first successful result is kept and the other
+          is cancelled (a blocking invoke already running on the threadpool
+          finishes, but its result is ignored).
+
+        Args:
+            invoke<func>: request-dict -> response-dict. a blocking function
+                (run on a threadpool) or a coroutine function. defaults to a
+                boto3 lambda invoke.
+            endpoint_url<str>: lambda endpoint (e.g. a local stub) for the
+                default invoke
+            function_name<str>: lambda function name
+            config<dict>: boto3 client config
+            window<int>: initial number of requests in flight
+            min_window<int>: smallest window
+            max_window<int>: largest window (and threadpool size)
+            retries<int>: max retries per request
+            backoff<float>: base backoff in seconds
+            max_backoff<float>: max backoff in seconds
+            deadline<float>: per-request deadline in seconds (None for no deadline)
+            hedge_percentile<float>: latency percentile (0-100) after which
+                an attempt is hedged (None for no hedging)
+            hedge_budget<float>: max hedges as a fraction of the requests
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,
+            invoke=None,
+            endpoint_url=None,
+            function_name=LAMBDA_FUNCTION_NAME,
+            config=BOTO3_CONFIG,
+            window=WINDOW,
+            min_window=MIN_WINDOW,
+            max_window=MAX_WINDOW,
+            retries=RETRIES,
+            backoff=BACKOFF,
+            max_backoff=MAX_BACKOFF,
+            deadline=DEADLINE,
+            hedge_percentile=None,
+            hedge_budget=HEDGE_BUDGET):
+        self.invoke=invoke or self._lambda_invoke
+        self.endpoint_url=endpoint_url
+        self.function_name=function_name
+        self.config=config
+        self.initial_window=window
+        self.min_window=max(min_window,1)
+        self.max_window=max(max_window,self.min_window)
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+        self.deadline=deadline
+        self.hedge_percentile=hedge_percentile
+        self.hedge_budget=hedge_budget
+        self.stats={}
+        self._client=None
+
+
+    def run(self,requests):
+        """ invoke requests
+
+            Returns:
+                list of (response, error) tuples in the order of requests.
+                error is None on success, else the last error message.
+        """
+        requests=list(requests)
+        results=[None]*len(requests)
+        for index,response,error in self.imap(requests):
+            results[index]=(response,error)
+        return results
+
+
+    def imap(self,requests):
+        """ invoke requests, yielding results as they complete
+
+            The event loop runs on its own thread (so this also works from
+            inside a running loop, e.g. a notebook). Results are handed over
+            as soon as they complete and are not kept by the invoker.
+
+            Yields:
+                (index, response, error) tuples in completion order
+        """
+        requests=list(requests)
+        if not requests:
+            return
+        results=queue.Queue()
+        def _run_loop():
+            try:
+                asyncio.run(self._run(requests,results.put))
+            except Exception as e:
+                results.put(e)
+        thread=threading.Thread(target=_run_loop)
+        thread.daemon=True
+        thread.start()
+        for _ in range(len(requests)):
+            result=results.get()
+            if isinstance(result,Exception):
+                raise result
+            yield result
+        thread.join()
+
+
+    def client(self):
+        if self._client is None:
+            config=dict({
+                    'retries': {'max_attempts': 0},
+                    'max_pool_connections': self.max_window },
+                **self.config)
+            self._client=boto3.client(
+                'lambda',
+                endpoint_url=self.endpoint_url,
+                config=Config(**config))
+        return self._client
+
+
+    #
+    # INTERNAL METHODS
+    #
+    async def _run(self,requests,on_result):
+        self.window=float(min(max(self.initial_window,self.min_window),self.max_window))
+        self._in_flight=0
+        self._last_decrease=None
+        self._slots=asyncio.Condition()
+        self._latencies=[]
+        self._threshold=None
+        self._threshold_samples=0
+        if self.hedge_percentile is None:
+            self._hedges_left=0
+        else:
+            self._hedges_left=int(math.ceil(self.hedge_budget*len(requests)))
+        self.stats={
+            'nb_requests': len(requests),
+            'nb_retries': 0,
+            'nb_throttles': 0,
+            'nb_errors': 0,
+            'nb_hedges': 0,
+            'nb_hedge_wins': 0,
+            'min_window': int(self.window),
+            'max_window': int(self.window) }
+        executor=ThreadPoolExecutor(max_workers=self.max_window)
+        try:
+            await asyncio.gather(*[
+                self._emit(index,request,executor,on_result)
+                for index,request in enumerate(requests)])
+        finally:
+            executor.shutdown(wait=False)
+
+
+    async def _emit(self,index,request,executor,on_result):
+        response,error=await self._invoke_request(request,executor)
+        on_result((index,response,error))
+
+
+    async def _invoke_request(self,request,executor):
+        start=time.monotonic()
+        error=None
+        for attempt in range(self.retries+1):
+            remaining=self._remaining(start)
+            if (remaining is not None) and (remaining<=0):
+                break
+            try:
+                response=await self._attempt(request,executor,remaining)
+                self._increase()
+                return response, None
+            except asyncio.TimeoutError:
+                error='deadline exceeded ({}s)'.format(self.deadline)
+            except Exception as e:
+                error=e
+                if _is_throttle(e):
+                    self.stats['nb_throttles']+=1
+                    self._decrease()
+            if attempt<self.retries:
+                delay=self._delay(attempt,self._remaining(start))
+                if delay is None:
+                    break
+                self.stats['nb_retries']+=1
+                await asyncio.sleep(delay)
+        self.stats['nb_errors']+=1
+        return None, "{}".format(error or 'deadline exceeded ({}s)'.format(self.deadline))
+
+
+    async def _attempt(self,request,executor,timeout):
+        """ a single (possibly hedged) attempt
+        """
+        await self._acquire()
+        start=time.monotonic()
+        tasks=[self._slot_task(request,executor)]
+        try:
+            if await self._hedge_due(tasks[0],start,timeout):
+                tasks.append(self._slot_task(request,executor))
+            if timeout is not None:
+                timeout-=time.monotonic()-start
+            return await asyncio.wait_for(self._first(tasks),timeout)
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()
+
+
+    async def _first(self,tasks):
+        """ result of the first task to succeed (or the last error)
+        """
+        pending=set(tasks)
+        error=None
+        while pending:
+            done,pending=await asyncio.wait(
+                pending,
+                return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is not tasks[0]:
+                        self.stats['nb_hedge_wins']+=1
+                    return task.result()
+                error=task.exception()
+        raise error
+
+
+    def _slot_task(self,request,executor):
+        """ task for a call holding a (pre-acquired) slot. the slot is
+            released when the task is done, even if cancelled before it starts
+        """
+        task=asyncio.ensure_future(self._timed_call(request,executor))
+        task.add_done_callback(lambda _: asyncio.ensure_future(self._release()))
+        return task
+
+
+    async def _timed_call(self,request,executor):
+        start=time.monotonic()
+        response=await self._call(request,executor)
+        self._latencies.append(time.monotonic()-start)
+        return response
+
+
+    async def _hedge_due(self,task,start,timeout):
+        """ wait until the task is done (False) or a hedge for it has been
+            reserved (True). the threshold is re-checked every HEDGE_POLL
+            seconds while there are too few samples or no free slots.
+        """
+        while self._hedges_left>0:
+            threshold=self._hedge_threshold()
+            elapsed=time.monotonic()-start
+            if (threshold is None) or (elapsed<threshold):
+                wait=HEDGE_POLL if (threshold is None) else (threshold-elapsed)
+            elif self._reserve_hedge():
+                return True
+            else:
+                wait=HEDGE_POLL
+            if (timeout is not None) and (elapsed+wait>=timeout):
+                return False
+            done,_=await asyncio.wait([task],timeout=wait)
+            if done:
+                return False
+        return False
+
+
+    def _hedge_threshold(self):
+        """ hedge_percentile latency (recomputed as samples grow by 5%)
+        """
+        nb_samples=len(self._latencies)
+        if (self._hedges_left<=0) or (nb_samples<MIN_HEDGE_SAMPLES):
+            return None
+        if (self._threshold is None) or (nb_samples>=1.05*self._threshold_samples):
+            latencies=sorted(self._latencies)
+            index=int(round((nb_samples-1)*self.hedge_percentile/100.0))
+            self._threshold=latencies[min(max(index,0),nb_samples-1)]
+            self._threshold_samples=nb_samples
+        return self._threshold
+
+
+    def _reserve_hedge(self):
+        """ take a hedge and a free slot, without waiting for a slot
+        """
+        if (self._hedges_left>0) and (self._in_flight<int(self.window)):
+            self._hedges_left-=1
+            self._in_flight+=1
+            self.stats['nb_hedges']+=1
+            return True
+        return False
+
+
+    def _call(self,request,executor):
+        if asyncio.iscoroutinefunction(self.invoke):
+            return self.invoke(request)
+        else:
+            return asyncio.get_running_loop().run_in_executor(
+                executor,
+                self.invoke,
+                request)
+
+
+    def _lambda_invoke(self,request):
+        response=self.client().invoke(
+            FunctionName=self.function_name,
+            InvocationType='RequestResponse',
+            LogType='Tail',
+            Payload=json.dumps(request))
+        return json.loads(response.get('Payload',{}).read())
+
+
+    async def _acquire(self):
+        async with self._slots:
+            await self._slots.wait_for(lambda: self._in_flight<int(self.window))
+            self._in_flight+=1
+
+
+    async def _release(self):
+        async with self._slots:
+            self._in_flight-=1
+            self._slots.notify_all()
+
+
+    def _increase(self):
+        self.window=min(self.window+1.0/self.window,self.max_window)
+        self.stats['max_window']=max(self.stats['max_window'],int(self.window))
+
+
+    def _decrease(self):
+        now=time.monotonic()
+        if (self._last_decrease is None) or (now-self._last_decrease>self.backoff):
+            self.window=max(self.window/2.0,self.min_window)
+            self._last_decrease=now
+            self.stats['min_window']=min(self.stats['min_window'],int(self.window))
+
+
+    def _delay(self,attempt,remaining):
+        """ full-jitter backoff (None if it would pass the deadline)
+        """
+        delay=random.uniform(0,min(self.max_backoff,self.backoff*(2**attempt)))
+        if (remaining is not None) and (delay>=remaining):
+            return None
+        return delay
+
+
+    def _remaining(self,start):
+        if self.deadline is None:
+            return None
+        return self.deadline-(time.monotonic()-start)
+
+
+
+
+def _is_throttle(error):
+    if isinstance(error,ThrottleError):
+        return True
+    code=(getattr(error,'response',None) or {}).get('Error',{}).get('Code')
+    return code in THROTTLE_CODES
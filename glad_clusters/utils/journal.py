@@ -0,0 +1,131 @@
+import os
+import json
+import zlib
+import hashlib
+import sqlite3
+
+
+OK_STATUS='ok'
+ERROR_STATUS='error'
+UNCHANGED_STATUS='unchanged'
+SCHEMA="""
+    CREATE TABLE IF NOT EXISTS tiles (
+        key TEXT NOT NULL,
+        x INTEGER NOT NULL,
+        y INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        response BLOB,
+        error TEXT,
+        PRIMARY KEY (key,x,y))
+"""
+
+
+def params_key(params):
+    """ hash of the (json-able) run params
+    """
+    return hashlib.sha1(
+        json.dumps(params,sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Journal(object):
+    """ Journal:
+
+        Per-tile checkpoints of a ClusterService run in a sqlite file. Each
+        tile's raw handler response is stored (zlib compressed json) as soon
+        as it completes, keyed by the run params and the tile x,y. Tiles that
+        failed (an exception, or a handler error response) are stored with
+        status 'error' so that a resumed run retries them. 'unchanged'
+        responses (see ClusterService.run(previous=...)) carry no clusters
+        and are not stored, so a resumed run re-runs those tiles.
+
+        Args:
+            path<str>: sqlite file path
+            params<dict>: run params (without x,y) used to key the tiles
+    """
+    #
+    # PUBLIC METHODS
+    #
+    def __init__(self,path,params):
+        self.path=path
+        self.key=params_key(params)
+        dirname=os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self._conn=sqlite3.connect(path)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute(SCHEMA)
+        self._conn.commit()
+
+
+    def completed(self):
+        """ set of (x,y) for the tiles that completed without error
+        """
+        rows=self._conn.execute(
+            'SELECT x,y FROM tiles WHERE key=? AND status=?',
+            (self.key,OK_STATUS))
+        return set((x,y) for x,y in rows)
+
+
+    def errors(self):
+        """ dict of (x,y): error message for the tiles that failed
+        """
+        rows=self._conn.execute(
+            'SELECT x,y,error FROM tiles WHERE key=? AND status=?',
+            (self.key,ERROR_STATUS))
+        return {(x,y): error for x,y,error in rows}
+
+
+    def responses(self,xys=None):
+        """ completed responses
+
+            Args:
+                xys<set>: if set only yield tiles in xys
+
+            Yields:
+                (x, y, response) tuples
+        """
+        rows=self._conn.execute(
+            'SELECT x,y,response FROM tiles WHERE key=? AND status=?',
+            (self.key,OK_STATUS))
+        for x,y,response in rows:
+            if (xys is None) or ((x,y) in xys):
+                yield x, y, decode_response(response)
+
+
+    def record(self,x,y,response,error=None):
+        """ checkpoint a tile
+
+            Args:
+                x,y<int,int>: tile
+                response<dict>: handler response
+                error<str>: error message if the invoke failed
+        """
+        if (not error) and response and (response.get('status')==UNCHANGED_STATUS):
+            return
+        if not error:
+            error=response and (response.get('error') or response.get('errorMessage'))
+        if error:
+            status,response=ERROR_STATUS,None
+        else:
+            status,response=OK_STATUS,encode_response(response)
+        self._conn.execute(
+            'INSERT OR REPLACE INTO tiles VALUES (?,?,?,?,?,?)',
+            (self.key,int(x),int(y),status,response,error and "{}".format(error)))
+        self._conn.commit()
+
+
+    def close(self):
+        self._conn.close()
+
+
+
+
+def encode_response(response):
+    """ zlib compressed json (sqlite blob) of a handler response
+    """
+    return sqlite3.Binary(zlib.compress(json.dumps(response).encode('utf-8')))
+
+
+def decode_response(data):
+    return json.loads(zlib.decompress(bytes(data)).decode('utf-8'))
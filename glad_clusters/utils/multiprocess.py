@@ -21,6 +21,26 @@ def map_with_threadpool(data_load_func,jobs_list,max_processes=MAX_THREADPOOL_PR
   return dfs.get()
 
 
+def imap_with_pool(data_load_func,jobs_list,max_processes=MAX_POOL_PROCESSES):
+  """ generator of results in completion order """
+  pool=Pool(processes=min(len(jobs_list),max_processes))
+  try:
+    for result in pool.imap_unordered(data_load_func,jobs_list):
+      yield result
+  finally:
+    _stop_pool(pool)
+
+
+def imap_with_threadpool(data_load_func,jobs_list,max_processes=MAX_THREADPOOL_PROCESSES):
+  """ generator of results in completion order """
+  pool=ThreadPool(processes=min(len(jobs_list),max_processes))
+  try:
+    for result in pool.imap_unordered(data_load_func,jobs_list):
+      yield result
+  finally:
+    _stop_pool(pool)
+
+
 def _stop_pool(pool):
   pool.close()
   pool.join()
@@ -51,6 +51,29 @@ cluster_group.add_argument("-c", "--min_count", dest="min_count",
                            help="Minimum number of alerts in a cluster", type=int, default=25)
 cluster_group.add_argument("-i", "--iterations", dest="iterations",
                            help="Number of times to iterate when finding clusters", type=int, default=25)
+cluster_group.add_argument("--widths", dest="widths", type=str, action=ToListAction,
+                           metavar="[WIDTH, ...]", help="Gaussian widths to sweep over")
+cluster_group.add_argument("--min_counts", dest="min_counts", type=str, action=ToListAction,
+                           metavar="[MIN_COUNT, ...]", help="Minimum counts to sweep over")
+cluster_group.add_argument("--engine", dest="engine", choices=["loop", "block", "grid"],
+                           help="Mean-shift engine (default loop)", default="loop")
+cluster_group.add_argument("--block_size", dest="block_size", type=int, default=256,
+                           help="Number of points per block for the block engine")
+cluster_group.add_argument("--cutoff", dest="cutoff", type=float,
+                           help="Kernel cutoff radius in pixels (block or grid engines)")
+cluster_group.add_argument("--tolerance", dest="tolerance", type=float,
+                           help="Shift (in pixels) below which points stop iterating")
+cluster_group.add_argument("--merge", dest="merge", type=float,
+                           help="Distance (in pixels) within which shifted points are merged")
+cluster_group.add_argument("--seeds", dest="seeds", type=int,
+                           help="Seed budget. Tiles with more alerts only shift binned seeds")
+
+cluster_group.add_argument("--encoding", dest="encoding", choices=["json", "packed"],
+                           help="Response alerts encoding (default json)", default="json")
+cluster_group.add_argument("--compression", dest="compression", choices=["zlib"],
+                           help="Compression for packed alerts")
+cluster_group.add_argument("--summary", dest="summary", action="store_true",
+                           help="Omit cluster alerts from responses (fetched on demand)")
 
 # Date group
 date_group = service_parser.add_argument_group("Dates", "Set start and end date.")
@@ -60,6 +83,28 @@ date_group.add_argument("--start_date", dest="start_date", type=str,
 date_group.add_argument("--end_date", dest="end_date", type=str,
                         metavar="YYYY-MM-DD", help="End date (optional), default today")
 
+# Execution group
+execution_group = service_parser.add_argument_group("Execution", "Select where tiles are clustered.")
+
+execution_group.add_argument("--backend", dest="backend", choices=["lambda", "local", "async"],
+                             help="Execution backend (default lambda)", default="lambda")
+execution_group.add_argument("--tiles_dir", dest="tiles_dir", type=str,
+                             help="Local tile directory ({z}/{x}/{y}.png) for the local backend")
+execution_group.add_argument("--hedge_percentile", dest="hedge_percentile", type=float,
+                             help="Re-issue tiles running longer than this latency percentile (async backend)")
+execution_group.add_argument("--hedge_budget", dest="hedge_budget", type=float,
+                             help="Max hedged tiles as a fraction of the tiles (default 0.05)")
+execution_group.add_argument("--stream", dest="stream", action="store_true",
+                             help="Decode tiles as they complete instead of keeping all responses (rows are still kept, see --stream_csv)")
+execution_group.add_argument("--resume", dest="resume", action="store_true",
+                             help="Checkpoint tiles to a local journal and skip tiles completed by an earlier run")
+execution_group.add_argument("--previous", dest="previous", type=str,
+                             help="Saved run (csv name) to refresh incrementally: unchanged tiles are carried forward")
+execution_group.add_argument("--cache", dest="cache", action="store_true",
+                             help="Reuse tile results cached locally by earlier runs with the same params")
+execution_group.add_argument("--cache_size", dest="cache_size", type=float,
+                             help="Max size of the local tile cache in MB (default 1024)")
+
 ################
 ## Save parser
 ################
@@ -77,6 +122,8 @@ save_group.add_argument("--bucket", dest="bucket", type=str,
                         help="S3 bucket in which CSV file will be saved (optional)")
 save_group.add_argument("--temp_dir", dest="temp_dir", type=str,
                         help="Temp directory.")
+save_group.add_argument("--stream_csv", dest="stream_csv", action="store_true",
+                        help="Append clusters to the local CSV as tiles complete instead of keeping them in memory (implies --stream and --local)")
 
 
 #############
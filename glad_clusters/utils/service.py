@@ -4,13 +4,19 @@ from datetime import datetime
 import math
 import itertools
 import json
+from urllib.request import urlopen
 import boto3
-from boto3.session import Config
 import numpy as np
 import pandas as pd
-import glad_clusters.utils.multiprocess as mp
+import glad_clusters.utils.backends as backends
+from glad_clusters.utils.journal import Journal
+from glad_clusters.utils.journal import UNCHANGED_STATUS
+import glad_clusters.utils.cache as cache_utils
 import psycopg2
 from glad_clusters.clusters.convex_hull import ConvexHull
+from glad_clusters.clusters.convex_hull import convex_hulls
+import glad_clusters.clusters.dates as dates
+import glad_clusters.clusters.payload as alerts_payload
 import inspect
 from argparse import ArgumentParser
 import copy
@@ -28,13 +34,35 @@ DEFAULT_END_DATE=datetime.now().strftime("%Y-%m-%d")
 DEFAULT_MIN_COUNT=25
 DEFAULT_WIDTH=5
 DEFAULT_ITERATIONS=25
+DEFAULT_WIDTHS=None
+DEFAULT_MIN_COUNTS=None
+DEFAULT_ENGINE='loop'
+DEFAULT_BLOCK_SIZE=256
+DEFAULT_CUTOFF=None
+DEFAULT_TOLERANCE=None
+DEFAULT_MERGE=None
+DEFAULT_SEEDS=None
+DEFAULT_ENCODING='json'
+DEFAULT_COMPRESSION=None
+DEFAULT_SUMMARY=False
+DEFAULT_BACKEND=backends.LAMBDA_BACKEND
+DEFAULT_JOURNAL_DIR=os.path.join(os.path.expanduser('~'),'.glad_clusters','journal')
+JOURNAL_IDENT='journal'
+DEFAULT_CACHE_DIR=os.path.join(os.path.expanduser('~'),'.glad_clusters','cache')
+DEFAULT_CACHE_SIZE=1024
+CACHE_FILE='tiles.sqlite'
+DEFAULT_TILES_URL='http://wri-tiles.s3.amazonaws.com/glad_prod/tiles'
 DEFAULT_ZOOM=12
 DELETE_RESPONSES=True
 DEFAULT_BUCKET='gfw-clusters-test'
-LAMBDA_FUNCTION_NAME='gfw-glad-clusters-v1-dev-meanshift'
+EMPTY_STATUS='empty'
+TIMESTAMP_FMT="%Y%m%d::%H:%M:%S"
+LAMBDA_FUNCTION_NAME=backends.LAMBDA_FUNCTION_NAME
 DEFAULT_CSV_IDENT='clusters'
 CSV_NAME_TMPL="{}_{}%{}_{}%{}%{}%{}_{}%{}%{}%{}"
-CONVERTERS={ "alerts" :lambda r: np.array(json.loads(r)) }
+CONVERTERS={
+    "alerts" :lambda r: np.array(json.loads(r)) if r else None,
+    "hull" :lambda r: np.array(json.loads(r)) if r else None }
 
 
 DATAFRAME_COLUMNS=[
@@ -47,7 +75,13 @@ DATAFRAME_COLUMNS=[
     'z','x','y','i','j',
     'file_name',
     'timestamp',
-    'alerts']
+    'alerts',
+    'hull',
+    'nb_iterations',
+    'mode']
+
+
+EXPORT_COLUMNS=DATAFRAME_COLUMNS[:DATAFRAME_COLUMNS.index('hull')]
 
 
 VIEW_COLUMNS=[
@@ -61,6 +95,28 @@ VIEW_COLUMNS=[
     'timestamp']
 
 
+FINGERPRINT_COLUMNS=[
+    'z','x','y',
+    'fingerprint']
+
+
+RUN_PARAMS=[
+    'z',
+    'tile_bounds',
+    'start_date',
+    'end_date',
+    'min_count',
+    'width',
+    'iterations',
+    'engine',
+    'block_size',
+    'cutoff',
+    'tolerance',
+    'merge',
+    'seeds',
+    'summary']
+
+
 ERROR_COLUMNS=[
     'z','x','y',
     'centroid_longitude',
@@ -68,10 +124,7 @@ ERROR_COLUMNS=[
     'error',
     'error_trace']
 
-BOTO3_CONFIG={
-    'read_timeout': 600,
-    'region_name': 'us-east-1'
-}
+BOTO3_CONFIG=backends.BOTO3_CONFIG
 
 MAX_PROCESSES=200
 
@@ -96,6 +149,30 @@ class ClusterService(object):
                 min_count<int>: minimum number of alerts in a cluster
                 width<int>: gaussian width in cluster algorithm
                 iterations<int>: number of times to iterate when finding clusters
+                widths<list>: gaussian widths to sweep over (see sweep())
+                min_counts<list>: minimum counts to sweep over (see sweep())
+                engine<str>: mean-shift engine ('loop', 'block' or 'grid')
+                block_size<int>: number of points per block for the 'block' engine
+                cutoff<float>: kernel cutoff radius in pixels ('block' or 'grid' engines)
+                tolerance<float>: shift (in pixels) below which points stop iterating
+                merge<float>: distance (in pixels) within which shifted points are merged
+                seeds<int>: seed budget. tiles with more alerts only shift binned seeds
+                encoding<str>: response alerts encoding ('json' or 'packed' binary columns)
+                compression<str>: compression for 'packed' alerts (None or 'zlib')
+                summary<bool>: if true responses omit the cluster alerts (see alerts()).
+                    stored as .summary_only (summary() is the clusters summary)
+                backend<str|backend>: 'lambda', 'local', 'async' or a utils.backends.Backend instance
+                tiles_dir<str>: local tile directory for the 'local' backend
+                tiles_url<str>: url of the tiles clustered by lambda (defaults
+                    to environ['url']). used to version tiles for the cache
+                journal_dir<str>: directory for run(resume=True) checkpoints
+                cache<bool>: if true keep successful tile responses in a local
+                    TileCache keyed by tile, dates, params, fingerprint and the
+                    tile's source version (ETag or mtime), and only invoke tiles
+                    that are not cached (see utils.cache). services with the
+                    same cache_dir share the cache and its in-flight requests
+                cache_dir<str>: directory for the tile cache
+                cache_size<int>: max size of the tile cache in MB
                 z<int>: tile-zoom
                 bucket<str>: aws-bucket used for saving csv file
 
@@ -105,7 +182,8 @@ class ClusterService(object):
                 dataframes directly.
 
                 dataframe<pandas.dataframe>,
-                errors_dataframe<pandas.dataframe>
+                errors_dataframe<pandas.dataframe>,
+                fingerprints_dataframe<pandas.dataframe>
     """
     @staticmethod
     def get_dataframes(filename,
@@ -139,6 +217,48 @@ class ClusterService(object):
         return df, edf
 
 
+    @staticmethod
+    def get_fingerprints(filename,
+            local=False,
+            region=DEFAULT_REGION,
+            bucket=DEFAULT_BUCKET,
+            url_base=None):
+        """ get tile fingerprints dataframe from csv (None if missing)
+
+            Args: see get_dataframes
+        """
+        if local:
+            fpath='{}.fingerprints.csv'.format(filename)
+        else:
+            dfpath=ClusterService.get_urls(filename,region,bucket,url_base,False)
+            fpath='{}.fingerprints.csv'.format(dfpath[:-len('.csv')])
+        try:
+            return pd.read_csv(fpath)
+        except:
+            return None
+
+
+    @staticmethod
+    def get_params(filename,
+            local=False,
+            region=DEFAULT_REGION,
+            bucket=DEFAULT_BUCKET,
+            url_base=None):
+        """ get the saved run params (see params) from json (None if missing)
+
+            Args: see get_dataframes
+        """
+        try:
+            if local:
+                with open('{}.params.json'.format(filename),'r') as file:
+                    return json.load(file)
+            else:
+                dfpath=ClusterService.get_urls(filename,region,bucket,url_base,False)
+                with urlopen('{}.params.json'.format(dfpath[:-len('.csv')])) as response:
+                    return json.loads(response.read().decode('utf-8'))
+        except:
+            return None
+
 
     @staticmethod
     def get_urls(filename,
@@ -189,16 +309,32 @@ class ClusterService(object):
             bucket,
             url_base,
             errors)
+        fdf=ClusterService.get_fingerprints(
+            filename,
+            local,
+            region,
+            bucket,
+            url_base)
         run_params=ClusterService.run_params(df)
+        run_params.update(ClusterService.get_params(
+            filename,
+            local,
+            region,
+            bucket,
+            url_base) or {})
         return ClusterService(
                 dataframe=df,
                 errors_dataframe=edf,
+                fingerprints_dataframe=fdf,
                 **run_params)
 
 
     @staticmethod
     def run_params(dataframe):
         """ return run params based on dataframe
+
+            NOTE: the dates are the range of the clusters, not of the run.
+            read_csv prefers the params saved with the csv (see params).
         """
         z=int(dataframe.iloc[0].z)
         x_min,y_min=dataframe[['x','y']].min().tolist()
@@ -217,10 +353,10 @@ class ClusterService(object):
     def int_to_str_dates(sdate,edate):
         """ convert date ints to date strs
         """
-        sdate, edate=str(sdate), str(edate)
-        sdate="{}-{}-{}".format(sdate[:4],sdate[4:6],sdate[6:])
-        edate="{}-{}-{}".format(edate[:4],edate[4:6],edate[6:])
-        return sdate, edate
+        if pd.isnull(sdate) or pd.isnull(edate):
+            return None, None
+        sdate, edate=dates.int_to_str([int(sdate),int(edate)])
+        return str(sdate), str(edate)
 
 
     @staticmethod
@@ -255,48 +391,154 @@ class ClusterService(object):
             min_count=DEFAULT_MIN_COUNT,
             width=DEFAULT_WIDTH,
             iterations=DEFAULT_ITERATIONS,
+            widths=DEFAULT_WIDTHS,
+            min_counts=DEFAULT_MIN_COUNTS,
+            engine=DEFAULT_ENGINE,
+            block_size=DEFAULT_BLOCK_SIZE,
+            cutoff=DEFAULT_CUTOFF,
+            tolerance=DEFAULT_TOLERANCE,
+            merge=DEFAULT_MERGE,
+            seeds=DEFAULT_SEEDS,
+            encoding=DEFAULT_ENCODING,
+            compression=DEFAULT_COMPRESSION,
+            summary=DEFAULT_SUMMARY,
+            backend=DEFAULT_BACKEND,
+            tiles_dir=None,
+            tiles_url=None,
+            journal_dir=DEFAULT_JOURNAL_DIR,
+            cache=False,
+            cache_dir=DEFAULT_CACHE_DIR,
+            cache_size=DEFAULT_CACHE_SIZE,
             z=DEFAULT_ZOOM,
             bucket=DEFAULT_BUCKET,
             dataframe=None,
-            errors_dataframe=None):
+            errors_dataframe=None,
+            fingerprints_dataframe=None):
         self._init_properties()
         self.start_date=start_date
         self.end_date=end_date
         self.min_count=min_count
         self.width=width
         self.iterations=iterations
+        self.widths=widths
+        self.min_counts=min_counts
+        self.engine=engine
+        self.block_size=block_size
+        self.cutoff=cutoff
+        self.tolerance=tolerance
+        self.merge=merge
+        self.seeds=seeds
+        self.encoding=encoding
+        self.compression=compression
+        self.summary_only=summary
+        self.backend=backends.get_backend(backend,tiles_dir)
+        self.journal_dir=journal_dir
+        self.cache=None
+        if cache:
+            self.cache=cache_utils.get_cache(
+                os.path.join(cache_dir,CACHE_FILE),
+                max_size=int(cache_size*2**20))
+            self.backend=cache_utils.CachedBackend(
+                self.backend,
+                self.cache,
+                tiles_url or os.environ.get('url') or DEFAULT_TILES_URL)
         self.z=z
         self.bucket=bucket
         self._dataframe=dataframe
         self._error_dataframe=errors_dataframe
+        self._fingerprints=_fingerprints_dict(fingerprints_dataframe)
         self._set_tile_bounds(bounds,tile_bounds,lon,lat,x,y)
 
 
-    def run(self,max_processes=MAX_PROCESSES,force=False):
+    def run(self,
+            max_processes=MAX_PROCESSES,
+            force=False,
+            hedge_percentile=None,
+            hedge_budget=None,
+            stream=False,
+            callback=None,
+            keep=True,
+            resume=False,
+            previous=None):
         """ find clusters on tiles
 
             Args:
                 max_processes<int>: number of processes used in launching jobs
                 force<bool[False]>: if true run even if dataframe is loaded
+                hedge_percentile<float>:
+                    re-issue tiles still running after this percentile (0-100)
+                    of completed tile latencies. async backend only. the number
+                    of hedges is reported in self.backend.stats['nb_hedges']
+                hedge_budget<float>: max hedges as a fraction of the tiles
+                stream<bool[False]>:
+                    if true decode each tile into row buffers as soon as it
+                    completes and drop the raw response, rather than keeping
+                    every response until the dataframes are built
+                callback<func>:
+                    (stream only) called as callback(x,y,dataframe,error) for
+                    each tile as it completes. dataframe holds the tile's
+                    clusters (see dataframe(full=True)), error the tile's error
+                    message or None
+                keep<bool[True]>:
+                    (stream only) if false do not keep cluster rows after the
+                    callback, so memory does not grow with the region. errors
+                    and skipped tiles are still kept.
+                resume<bool[False]>:
+                    if true checkpoint each tile to the journal (see journal())
+                    as it completes, and skip tiles already completed by an
+                    earlier run with the same params. tiles that are missing
+                    or errored are (re-)run. implies stream.
+                previous<ClusterService>:
+                    incremental refresh. each tile is sent with its fingerprint
+                    (see fingerprints()) from the previous run. tiles whose
+                    alerts and params are unchanged are not re-clustered and
+                    their rows are carried forward from previous. tiles that
+                    are re-run are sent the previous cluster centroids (i,j)
+                    on the tile to warm-start mean-shift (see MShift centroids).
+
+            With cache=True tiles are first looked up in the tile cache and
+            the cache hits/misses for the run are printed.
         """
         if (self._dataframe is not None) and (not force):
             print("WARNING: data already loaded pass 'force=True' to overwrite")
         else:
             try:
                 # self.responses=None
-                self.lambda_client=boto3.client('lambda',config=Config(**BOTO3_CONFIG))
-                if (self.x and self.y):
-                    self.responses=[self._run_tile()]
+                self._set_previous(previous)
+                self._unassigned={}
+                self._dirty=set()
+                if self.cache:
+                    self.backend.reset_cache_stats()
+                if stream or resume:
+                    self._stream_tiles(
+                        self._xys(),
+                        max_processes,
+                        hedge_percentile,
+                        hedge_budget,
+                        callback,
+                        keep,
+                        self.journal() if resume else None)
                 else:
-                    xys=itertools.product(
-                        range(self.x_min,self.x_max+1),
-                        range(self.y_min,self.y_max+1))
-                    self.responses=mp.map_with_threadpool(
-                        self._run_tile,
-                        list(xys),
-                        max_processes=max_processes)
-                self._dataframe=None
-                self._errors=None
+                    if (self.x and self.y):
+                        self.responses=[self._run_tile()]
+                    else:
+                        xys=self._xys()
+                        results=self.backend.map(
+                            [self._request_data(x,y,as_dict=True) for x,y in xys],
+                            max_processes,
+                            hedge_percentile=hedge_percentile,
+                            hedge_budget=hedge_budget)
+                        self.responses=[
+                            self._tile_response(x,y,response,error)
+                            for (x,y),(response,error) in zip(xys,results)]
+                    self._dataframe=None
+                    self._errors=None
+                if self.cache:
+                    print("CACHE: {} hits, {} misses, {} deduplicated, {} unversioned".format(
+                        self.backend.cache_stats['nb_cache_hits'],
+                        self.backend.cache_stats['nb_cache_misses'],
+                        self.backend.cache_stats['nb_cache_dedups'],
+                        self.backend.cache_stats['nb_cache_unversioned']))
             except Exception as e:
                 print("ERROR: run failure -- {}".format(e))
 
@@ -311,6 +553,19 @@ class ClusterService(object):
                 self.z,self.width,self.min_count,self.iterations)
 
 
+    def filename(self,
+            ident=DEFAULT_CSV_IDENT,
+            filename=None,
+            local=False,
+            temp_dir=None):
+        """ name/path (without extension) that save writes to. see save
+        """
+        if not filename: filename=self.name(ident)
+        if temp_dir and local:
+            filename = os.path.join(temp_dir, filename)
+        return filename
+
+
     def urls(self,
             ident=DEFAULT_CSV_IDENT,
             region=DEFAULT_REGION,
@@ -350,7 +605,8 @@ class ClusterService(object):
             local=False,
             bucket=None,
             errors=True,
-            temp_dir=None):
+            temp_dir=None,
+            clusters=True):
         """ write responses to csv
 
             Args:
@@ -365,33 +621,73 @@ class ClusterService(object):
                     local<bool[False]>: if true write to local file else write to s3 file
                     bucket<str>: aws-bucket required if not local and not self.bucket
                     errors<bool[True]>: if true save errors-csv
+                    clusters<bool[True]>:
+                        if false do not write the clusters csv (it was written
+                        as the run streamed, see CSVStream)
+
+            The sweep() dataframes are saved to <filename>.w<width>_c<min_count>.csv
         """
-        if not filename: filename=self.name(ident)
-        if temp_dir and local:
-            filename = os.path.join(temp_dir, filename)
+        filename=self.filename(ident,filename,local,temp_dir)
         if self._dataframe is None: self._process_responses()
-        self._dataframe['alerts']=self._dataframe['alerts'].apply(lambda a: a.tolist())
+        fingerprints=self.fingerprints_dataframe()
+        params=json.dumps(self.params())
+        sweeps=[
+            ("{}.w{}_c{}.csv".format(filename,width,min_count),
+                _csv_dataframe(dataframe))
+            for (width,min_count),dataframe in sorted(self.sweep().items()) ]
+        self._dataframe['alerts']=self._dataframe['alerts'].apply(_to_list)
+        if 'hull' in self._dataframe:
+            self._dataframe['hull']=self._dataframe['hull'].apply(_to_list)
         if local:
-            self.dataframe(full=True).to_csv(
-                "{}.csv".format(filename),
-                index=None)
+            if clusters:
+                self.dataframe(full=True).to_csv(
+                    "{}.csv".format(filename),
+                    index=None)
             if errors and self.errors().shape[0]:
                 self.errors().to_csv(
                     "{}.errors.csv".format(filename),
                     index=None)
+            if fingerprints.shape[0]:
+                fingerprints.to_csv(
+                    "{}.fingerprints.csv".format(filename),
+                    index=None)
+            with open("{}.params.json".format(filename),'w') as file:
+                file.write(params)
+            for sweep_filename,dataframe in sweeps:
+                dataframe.to_csv(sweep_filename,index=None)
         else:
-            obj=boto3.resource('s3').Object(
-                bucket or self.bucket,
-                "{}.csv".format(filename))
-            obj.put(Body=self.dataframe(full=True).to_csv(None,index=None))
-            obj.Acl().put(ACL=CSV_ACL)
+            if clusters:
+                obj=boto3.resource('s3').Object(
+                    bucket or self.bucket,
+                    "{}.csv".format(filename))
+                obj.put(Body=self.dataframe(full=True).to_csv(None,index=None))
+                obj.Acl().put(ACL=CSV_ACL)
             if errors and self.errors().shape[0]:
                 obj=boto3.resource('s3').Object(
                     bucket or self.bucket,
                     "{}.errors.csv".format(filename))
                 obj.put(Body=self.errors().to_csv(None,index=None))
                 obj.Acl().put(ACL=CSV_ACL)
-        self._dataframe['alerts']=self._dataframe['alerts'].apply(lambda a: np.array(a))
+            if fingerprints.shape[0]:
+                obj=boto3.resource('s3').Object(
+                    bucket or self.bucket,
+                    "{}.fingerprints.csv".format(filename))
+                obj.put(Body=fingerprints.to_csv(None,index=None))
+                obj.Acl().put(ACL=CSV_ACL)
+            obj=boto3.resource('s3').Object(
+                bucket or self.bucket,
+                "{}.params.json".format(filename))
+            obj.put(Body=params)
+            obj.Acl().put(ACL=CSV_ACL)
+            for sweep_filename,dataframe in sweeps:
+                obj=boto3.resource('s3').Object(
+                    bucket or self.bucket,
+                    sweep_filename)
+                obj.put(Body=dataframe.to_csv(None,index=None))
+                obj.Acl().put(ACL=CSV_ACL)
+        self._dataframe['alerts']=self._dataframe['alerts'].apply(_to_array)
+        if 'hull' in self._dataframe:
+            self._dataframe['hull']=self._dataframe['hull'].apply(_to_array)
 
     def export(self,
                format="PG",
@@ -429,7 +725,11 @@ class ClusterService(object):
                     overwrite<bool[False]>: if true write overwrite existing data
                     concave<int(100)>: Percentage of convex area
 
+            NOTE: only dataframe() is exported. Runs with widths/min_counts
+            (see sweep()) can not be exported, use save.
         """
+        if self.widths or self.min_counts:
+            raise Exception('Sweeps (widths/min_counts) can not be exported.')
 
         if format == "PG":
 
@@ -446,8 +746,8 @@ class ClusterService(object):
                 self._process_responses()
 
             self._dataframe['alerts'] = self._dataframe['alerts'].apply(
-                lambda a: str(a.tolist()).replace('[', '{').replace(']', '}'))
-            self.dataframe(full=True).to_csv(filename, index=None)
+                lambda a: None if a is None else str(a.tolist()).replace('[', '{').replace(']', '}'))
+            self.dataframe(full=True)[['index']+EXPORT_COLUMNS].to_csv(filename, index=None)
 
             # if errors and self.errors().shape[0]:
             #     self.errors().to_csv("{}.errors.csv".format(filename), index=None)
@@ -477,13 +777,40 @@ class ClusterService(object):
             conn.close()
 
             os.remove(filename)
-            self._dataframe['alerts'] = self._dataframe['alerts'].apply(lambda a: np.array(a))
+            self._dataframe['alerts'] = self._dataframe['alerts'].apply(_to_array)
 
         else:
             raise Exception('Unsupported format.')
 
         return pg_table
 
+    def journal(self):
+        """ checkpoint journal for the current run params
+
+            The journal is a sqlite file in journal_dir named by name(). Tiles
+            are keyed by all of the request params.
+        """
+        params=self._request_data(None,None,as_dict=True)
+        params.pop('x')
+        params.pop('y')
+        params.pop('fingerprint')
+        params.pop('centroids')
+        return Journal(
+            os.path.join(
+                self.journal_dir,
+                '{}.sqlite'.format(self.name(JOURNAL_IDENT))),
+            params)
+
+
+    def params(self):
+        """ dict of the RUN_PARAMS of this service. these are saved with
+            the csv (see save) and restored by read_csv
+        """
+        params=self._request_data(None,None,as_dict=True)
+        params['tile_bounds']=[[self.x_min,self.y_min],[self.x_max,self.y_max]]
+        return { k: _to_json(params[k]) for k in RUN_PARAMS }
+
+
     def request_size(self):
         """ get number of tiles in request
         """
@@ -565,6 +892,65 @@ class ClusterService(object):
             return df[VIEW_COLUMNS]
 
 
+    def sweep(self):
+        """ return dataframes for a width/min_count sweep
+
+            Runs with widths and/or min_counts set return results for
+            every combination from a single run. dataframe() holds the
+            combination for self.width,self.min_count (if it was swept).
+
+            Returns:
+                dict of dataframes keyed by (width,min_count)
+        """
+        if  self._dataframe is None:
+            self._process_responses()
+        return self._sweep_dataframes
+
+
+    def skipped(self):
+        """ return number of tiles the handler skipped without clustering
+            because they had fewer alerts than min_count
+        """
+        if  self._dataframe is None:
+            self._process_responses()
+        return self._nb_skipped
+
+
+    def unchanged(self):
+        """ return number of tiles carried forward by run(previous=...)
+        """
+        if  self._dataframe is None:
+            self._process_responses()
+        return self._nb_unchanged
+
+
+    def fingerprints(self):
+        """ return dict of tile fingerprints keyed by (x,y)
+
+            A fingerprint is a hash of a tile's filtered alerts and the
+            clustering params, returned by the handler for every tile
+            that did not error.
+        """
+        if  self._dataframe is None:
+            self._process_responses()
+        return self._fingerprints
+
+
+    def fingerprints_dataframe(self):
+        """ return fingerprints as a FINGERPRINT_COLUMNS dataframe
+        """
+        return pd.DataFrame(
+            [[self.z,x,y,fingerprint]
+                for (x,y),fingerprint in sorted(self.fingerprints().items())],
+            columns=FINGERPRINT_COLUMNS)
+
+
+    def dirty(self):
+        """ return sorted list of tiles (x,y) marked dirty by update
+        """
+        return sorted(self._dirty)
+
+
     def errors(self):
         """ return error dataframe
         """
@@ -627,6 +1013,23 @@ class ClusterService(object):
             return row[VIEW_COLUMNS]
 
 
+    def alerts(self,row_id):
+        """ get alerts for cluster
+
+            Runs with summary=True do not return alerts. They are fetched on
+            demand by re-running the cluster's tile and are then kept for
+            every cluster on that tile.
+
+            Args:
+                row_id<int>: dataframe row index for cluster
+        """
+        row=self.dataframe(full=True).iloc[row_id]
+        if row.alerts is None:
+            self._fetch_alerts(int(row.x),int(row.y))
+            row=self.dataframe(full=True).iloc[row_id]
+        return row.alerts
+
+
     def convex_hull(self,row_id=None,alerts=None):
         """ get convex_hull vertices for cluster
 
@@ -635,8 +1038,64 @@ class ClusterService(object):
                 alerts<array>: alerts for cluster
         """
         if alerts is None:
-            alerts=self.dataframe(full=True).iloc[row_id].alerts
-        return ConvexHull(alerts[:,0:2]).hull
+            row=self.dataframe(full=True).iloc[row_id]
+            if row.get('hull') is not None:
+                return row.hull
+            alerts=self.alerts(row_id)
+        return ConvexHull(alerts[:,0:2],prefilter=True).hull
+
+
+    def update(self,new_alerts,radius=None,dirty_threshold=None):
+        """ assign new alerts to existing clusters without re-clustering
+
+            Each alert is assigned to the nearest cluster mode (i,j) on its
+            tile that is within radius. The count, min/max dates, hull, area,
+            alerts (if loaded) and timestamp of the cluster are updated in
+            place. Alerts with no mode in range are held per tile and once a
+            tile holds dirty_threshold of them it is marked dirty (see dirty()).
+            Dirty tiles should be re-clustered, e.g. with
+            run(force=True,previous=service) which only re-runs changed tiles.
+            The sweep() dataframes are not updated.
+
+            Args:
+                new_alerts<dict>: [i,j,days] valued arrays keyed by tile (x,y).
+                    days are days since the GLAD epoch
+                radius<float>: max distance (in pixels) from a mode
+                    (defaults to width)
+                dirty_threshold<int>: number of unassigned alerts that marks a
+                    tile dirty (defaults to min_count)
+
+            Returns:
+                VIEW_COLUMNS dataframe of the updated clusters
+        """
+        if radius is None: radius=self.width
+        if dirty_threshold is None: dirty_threshold=self.min_count
+        df=self.dataframe(full=True)
+        timestamp=datetime.now().strftime(TIMESTAMP_FMT)
+        modes=df[['i','j']].values.astype(float)
+        updated=[]
+        for (x,y),alerts in new_alerts.items():
+            xy=(int(x),int(y))
+            alerts=_to_array(alerts).reshape(-1,3)
+            row_ids=np.flatnonzero(((df.z==self.z)&(df.x==xy[0])&(df.y==xy[1])).values)
+            assigned=np.full(alerts.shape[0],-1)
+            if row_ids.size and alerts.size:
+                dists=np.sqrt((
+                    (alerts[:,None,:2]-modes[None,row_ids])**2).sum(axis=-1))
+                nearest=dists.argmin(axis=1)
+                in_range=dists[np.arange(alerts.shape[0]),nearest]<=radius
+                assigned[in_range]=row_ids[nearest[in_range]]
+            for row_id in np.unique(assigned[assigned>=0]):
+                self._update_cluster(row_id,alerts[assigned==row_id],timestamp)
+                updated.append(row_id)
+            unassigned=alerts[assigned<0]
+            if unassigned.size:
+                if xy in self._unassigned:
+                    unassigned=np.vstack([self._unassigned[xy],unassigned])
+                self._unassigned[xy]=unassigned
+                if unassigned.shape[0]>=dirty_threshold:
+                    self._dirty.add(xy)
+        return df.iloc[sorted(updated)][VIEW_COLUMNS]
 
 
 
@@ -647,6 +1106,13 @@ class ClusterService(object):
     def _init_properties(self):
         self.x=None
         self.y=None
+        self._sweep_dataframes={}
+        self._nb_skipped=None
+        self._nb_unchanged=0
+        self._fingerprints={}
+        self._unassigned={}
+        self._dirty=set()
+        self._set_previous(None)
 
 
     def _request_data(self,x,y,as_dict=False):
@@ -658,13 +1124,54 @@ class ClusterService(object):
             "end_date":self.end_date,
             "min_count":self.min_count,
             "width":self.width,
-            "iterations":self.iterations }
+            "iterations":self.iterations,
+            "widths":self.widths,
+            "min_counts":self.min_counts,
+            "engine":self.engine,
+            "block_size":self.block_size,
+            "cutoff":self.cutoff,
+            "tolerance":self.tolerance,
+            "merge":self.merge,
+            "seeds":self.seeds,
+            "encoding":self.encoding,
+            "compression":self.compression,
+            "summary":self.summary_only,
+            "fingerprint":self._previous_fingerprints.get((x,y)),
+            "centroids":self._previous_centroids.get((x,y)) }
         if as_dict:
             return data
         else:
             return json.dumps(data)
 
 
+    def _set_previous(self,previous):
+        """ fingerprints and rows (by tile) of a previous run
+        """
+        if previous is None:
+            self._previous_fingerprints={}
+            self._previous_rows={}
+            self._previous_sweep_rows={}
+        else:
+            self._previous_fingerprints=previous.fingerprints()
+            self._previous_rows=_tile_rows(previous.dataframe(full=True))
+            self._previous_sweep_rows={
+                key: _tile_rows(dataframe)
+                for key,dataframe in previous.sweep().items() }
+        i_col,j_col=DATAFRAME_COLUMNS.index('i'),DATAFRAME_COLUMNS.index('j')
+        self._previous_centroids={
+            xy: [[int(row[i_col]),int(row[j_col])] for row in rows]
+            for xy,rows in self._previous_rows.items() }
+
+
+    def _xys(self):
+        if (self.x and self.y):
+            return [(self.x,self.y)]
+        else:
+            return list(itertools.product(
+                range(self.x_min,self.x_max+1),
+                range(self.y_min,self.y_max+1)))
+
+
     def _set_tile_bounds(self,bounds,tile_bounds,lon,lat,x,y):
         """
             NOTE: if a single pair (x,y) or (lon,lat) the x,y-values 
@@ -691,14 +1198,101 @@ class ClusterService(object):
         return int(x),int(y)
 
 
-    def _process_response(self,x,y,response):
-        if response:
-            payload=json.loads(response.get('Payload',{}).read())
-            processed_response=self._request_data(x,y,as_dict=True)
-            if payload:
-                processed_response.update(payload)
-            return processed_response
-        return None
+    def _fetch_alerts(self,x,y):
+        """ re-run tile x,y with alerts and add them to the dataframe
+
+            raises if the re-run does not reproduce the tile's clusters (a
+            cluster that is missing or whose count differs)
+        """
+        data=self._request_data(x,y,as_dict=True)
+        data.update({
+            'widths': None,
+            'min_counts': None,
+            'summary': False,
+            'fingerprint': None })
+        response=self._process_response(x,y,self.backend.invoke(data))
+        error=response and (response.get('error') or response.get('errorMessage'))
+        if error:
+            raise Exception('failed to fetch alerts for tile {}/{} -- {}'.format(x,y,error))
+        alerts={
+            (int(c['i']),int(c['j'])): _to_array(c.get('alerts'))
+            for c in ((response or {}).get('data') or {}).get('clusters',[]) }
+        df=self._dataframe
+        tile=((df.z==self.z)&(df.x==x)&(df.y==y)).values
+        values=np.empty(df.shape[0],dtype=object)
+        rows=zip(tile,df.i,df.j,df['count'],df.alerts)
+        for k,(is_tile,i,j,count,row_alerts) in enumerate(rows):
+            if is_tile and (row_alerts is None):
+                row_alerts=alerts.get((int(i),int(j)))
+                if (row_alerts is None) or (len(row_alerts)!=int(count)):
+                    raise Exception(
+                        'failed to fetch alerts for tile {}/{} -- cluster {},{} '
+                        'was not reproduced (check the run params)'.format(x,y,i,j))
+            values[k]=row_alerts
+        df['alerts']=values
+
+
+    def _update_cluster(self,row_id,alerts,timestamp):
+        """ add [i,j,days] alerts to the cluster at dataframe row row_id
+
+            the new hull is the hull of the old hull's vertices (or the
+            cluster's alerts, or its mode) and the new alerts
+        """
+        df=self._dataframe
+        row=df.iloc[row_id]
+        if row.hull is not None:
+            points=row.hull
+        elif row.alerts is not None:
+            points=row.alerts[:,:2]
+        else:
+            points=[[row.i,row.j]]
+        points=np.vstack([
+            np.asarray(points).reshape(-1,2),
+            alerts[:,:2]]).astype(int)
+        hulls,areas=convex_hulls(points,[0,points.shape[0]])
+        min_date,max_date=dates.days_to_int(
+            [alerts[:,2].min(),alerts[:,2].max()])
+        values={
+            'count': int(row['count'])+alerts.shape[0],
+            'area': int(round(areas[0])),
+            'min_date': min(int(row.min_date),int(min_date)),
+            'max_date': max(int(row.max_date),int(max_date)),
+            'timestamp': timestamp,
+            'hull': _to_array(hulls[0]) }
+        if row.alerts is not None:
+            values['alerts']=np.vstack([row.alerts,alerts])
+        for column,value in values.items():
+            df.iat[row_id,df.columns.get_loc(column)]=value
+
+
+    def _process_response(self,x,y,payload):
+        processed_response=self._request_data(x,y,as_dict=True)
+        if payload:
+            self._unpack_alerts(payload)
+            processed_response.update(payload)
+        return processed_response
+
+
+    def _tile_response(self,x,y,response,error=None):
+        if error:
+            error_data=self._request_data(x,y,as_dict=True)
+            error_data['data']={ 'x':x, 'y': y }
+            error_data['error']=error
+            error_data['error_trace']="service.1"
+            return error_data
+        else:
+            return self._process_response(x,y,response)
+
+
+    def _unpack_alerts(self,payload):
+        """ replace packed alerts with per-cluster alert arrays
+        """
+        data=payload.get('data') or {}
+        for result in data.get('sweep',[data]):
+            if alerts_payload.is_packed(result.get('alerts')):
+                alerts=alerts_payload.unpack(result.pop('alerts'))
+                for cluster,cluster_alerts in zip(result.get('clusters',[]),alerts):
+                    cluster['alerts']=cluster_alerts
 
 
     def _run_tile(self,location=None,x=None,y=None):
@@ -717,57 +1311,163 @@ class ClusterService(object):
             x=self.x
             y=self.y
         if (x and y):
-            try:
-                response=self.lambda_client.invoke(
-                    FunctionName=LAMBDA_FUNCTION_NAME,
-                    InvocationType='RequestResponse',
-                    LogType='Tail',
-                    Payload=self._request_data(x,y))
-                return self._process_response(x,y,response)
-            except Exception as e:
-                error_data=self._request_data(x,y,as_dict=True)
-                error_data['data']={ 'x':x, 'y': y }
-                error_data['error']="{}".format(e)
-                error_data['error_trace']="service.1"
-                return error_data
+            response,error=self.backend.safe_invoke(
+                self._request_data(x,y,as_dict=True))
+            return self._tile_response(x,y,response,error)
+
+
+    def _stream_tiles(self,
+            xys,
+            max_processes,
+            hedge_percentile,
+            hedge_budget,
+            callback,
+            keep,
+            journal=None):
+        """ ingest tiles as they complete (see run(stream=True))
+
+            with a journal: completed tiles are read back from the journal
+            and the rest are checkpointed as they complete
+        """
+        buffers=self._buffers()
+        try:
+            if journal:
+                completed=journal.completed()
+                for x,y,response in journal.responses(set(xys)):
+                    self._stream_tile(buffers,x,y,response,None,callback,keep)
+                xys=[xy for xy in xys if xy not in completed]
+            if xys:
+                results=self.backend.imap(
+                    [self._request_data(x,y,as_dict=True) for x,y in xys],
+                    max_processes,
+                    hedge_percentile=hedge_percentile,
+                    hedge_budget=hedge_budget)
+                for index,response,error in results:
+                    x,y=xys[index]
+                    if journal:
+                        journal.record(x,y,response,error)
+                    self._stream_tile(buffers,x,y,response,error,callback,keep)
+        finally:
+            if journal:
+                journal.close()
+        self.responses=None
+        self._set_dataframes(buffers)
+
+
+    def _stream_tile(self,buffers,x,y,response,error,callback,keep):
+        response=self._tile_response(x,y,response,error)
+        tile_buffers=self._buffers()
+        self._ingest(tile_buffers,response)
+        if callback:
+            callback(
+                x,y,
+                self._clusters_dataframe(self._main_rows(tile_buffers)),
+                response.get('error') or response.get('errorMessage'))
+        self._merge_buffers(buffers,tile_buffers,keep)
 
 
     def _process_responses(self):
-        rows,error_rows=self._dataframes_rows()
-        self._dataframe=pd.DataFrame(
-            rows,
-            columns=DATAFRAME_COLUMNS)
+        buffers=self._buffers()
+        for response in self.responses:
+            self._ingest(buffers,response)
+        self._set_dataframes(buffers)
+        if DELETE_RESPONSES: self.responses=None
+
+
+    def _buffers(self):
+        return {
+            'rows': [],
+            'error_rows': [],
+            'sweep_rows': {},
+            'fingerprints': {},
+            'nb_skipped': 0,
+            'nb_unchanged': 0 }
+
+
+    def _merge_buffers(self,buffers,tile_buffers,keep=True):
+        buffers['error_rows']+=tile_buffers['error_rows']
+        buffers['nb_skipped']+=tile_buffers['nb_skipped']
+        buffers['nb_unchanged']+=tile_buffers['nb_unchanged']
+        buffers['fingerprints'].update(tile_buffers['fingerprints'])
+        if keep:
+            buffers['rows']+=tile_buffers['rows']
+            for key,srows in tile_buffers['sweep_rows'].items():
+                buffers['sweep_rows'].setdefault(key,[]).extend(srows)
+
+
+    def _main_rows(self,buffers):
+        """ rows for self.width,self.min_count """
+        if buffers['sweep_rows']:
+            return buffers['sweep_rows'].get((self.width,self.min_count),[])
+        else:
+            return buffers['rows']
+
+
+    def _set_dataframes(self,buffers):
+        self._nb_skipped=buffers['nb_skipped']
+        self._nb_unchanged=buffers['nb_unchanged']
+        self._fingerprints=buffers['fingerprints']
+        self._sweep_dataframes={}
+        for key,srows in buffers['sweep_rows'].items():
+            self._sweep_dataframes[key]=self._clusters_dataframe(srows)
+        self._dataframe=self._clusters_dataframe(self._main_rows(buffers))
         self._error_dataframe=pd.DataFrame(
-            error_rows,
+            buffers['error_rows'],
             columns=ERROR_COLUMNS)
-        self._dataframe.sort_values(
+        self._error_dataframe.reset_index(inplace=True)
+
+
+    def _clusters_dataframe(self,rows):
+        dataframe=pd.DataFrame(
+            rows,
+            columns=DATAFRAME_COLUMNS)
+        dataframe.sort_values(
             'timestamp',
             ascending=False,
             inplace=True)
-        self._dataframe.reset_index(inplace=True)
-        self._error_dataframe.reset_index(inplace=True)
-        if DELETE_RESPONSES: self.responses=None
+        dataframe.reset_index(inplace=True)
+        return dataframe
 
 
-    def _dataframes_rows(self):
-        rows=[]
-        error_rows=[]
-        for response in self.responses:
-            if response:
-                error=response.get('error') or response.get('errorMessage')
-                if error:
-                    error_rows.append(self._error_row(error,response))
-                else:
-                    rows+=self._response_rows(response)
-        return rows,error_rows
+    def _ingest(self,buffers,response):
+        """ decode a tile response into the row buffers
+        """
+        if response:
+            if response.get('status')==EMPTY_STATUS:
+                buffers['nb_skipped']+=1
+            error=response.get('error') or response.get('errorMessage')
+            if error:
+                buffers['error_rows'].append(self._error_row(error,response))
+                return
+            xy=(int(response['x']),int(response['y']))
+            if response.get('fingerprint'):
+                buffers['fingerprints'][xy]=response['fingerprint']
+            if response.get('status')==UNCHANGED_STATUS:
+                buffers['nb_unchanged']+=1
+                buffers['rows']+=self._previous_rows.get(xy,[])
+                for key,tile_rows in self._previous_sweep_rows.items():
+                    buffers['sweep_rows'].setdefault(key,[]).extend(
+                        tile_rows.get(xy,[]))
+            elif response.get('data',{}).get('sweep'):
+                for result in response['data']['sweep']:
+                    key=(result['width'],result['min_count'])
+                    buffers['sweep_rows'].setdefault(key,[]).extend(
+                        self._response_rows(response,result))
+            else:
+                buffers['rows']+=self._response_rows(response)
 
 
-    def _response_rows(self,response):
+    def _response_rows(self,response,result=None):
+        """ rows for the clusters in result (a sweep result, defaults to
+            the response data). nb_iterations and mode are per tile.
+        """
         rrows=[]
         z=int(response.get('z'))
         x=int(response.get('x'))
         y=int(response.get('y'))
-        for cluster in response.get('data',{}).get('clusters',[]):
+        if result is None:
+            result=response.get('data',{})
+        for cluster in result.get('clusters',[]):
             i=int(cluster.get('i'))
             j=int(cluster.get('j'))
             rrows.append([
@@ -780,7 +1480,10 @@ class ClusterService(object):
                     z,x,y,i,j,
                     response['file_name'],
                     response['timestamp'],
-                    np.array(cluster.get('alerts')).astype(int)])
+                    _to_array(cluster.get('alerts')),
+                    _to_array(cluster.get('hull')),
+                    result.get('nb_iterations'),
+                    result.get('mode')])
         return rrows
 
 
@@ -801,6 +1504,102 @@ class ClusterService(object):
         test=[ (val is not None) for val in values ]
         return np.prod(test).astype(bool)
 
+
+
+
+class CSVStream(object):
+    """ CSVStream:
+
+        run(stream=True,keep=False) callback that appends each tile's
+        clusters to a csv as the tile completes, so the rows are written
+        without being kept in memory. Totals for the streamed clusters are
+        kept for summary().
+
+        Args:
+            filename<str>: name/path of csv without '.csv' extension
+    """
+    def __init__(self,filename):
+        self.path="{}.csv".format(filename)
+        self.nb_clusters=0
+        self.count=0
+        self.area=0
+        self.min_date=np.nan
+        self.max_date=np.nan
+        pd.DataFrame(columns=['index']+DATAFRAME_COLUMNS).to_csv(
+            self.path,
+            index=None)
+
+
+    def __call__(self,x,y,dataframe,error):
+        if dataframe.shape[0]:
+            dataframe=_csv_dataframe(dataframe)
+            dataframe['index']+=self.nb_clusters
+            dataframe.to_csv(self.path,mode='a',header=False,index=None)
+            self.nb_clusters+=dataframe.shape[0]
+            self.count+=dataframe['count'].sum()
+            self.area+=dataframe.area.sum()
+            self.min_date=np.nanmin([dataframe.min_date.min(),self.min_date])
+            self.max_date=np.nanmax([dataframe.max_date.max(),self.max_date])
+
+
+    def summary(self):
+        """ nb_clusters,total-count/area,min_date,max_date (see ClusterService.summary)
+        """
+        min_date,max_date=ClusterService.int_to_str_dates(self.min_date,self.max_date)
+        return self.nb_clusters, self.count, self.area, min_date, max_date
+
+
+
+
+def _tile_rows(dataframe):
+    """ DATAFRAME_COLUMNS rows keyed by tile (x,y)
+    """
+    dataframe=dataframe.reindex(columns=DATAFRAME_COLUMNS)
+    return {
+        (int(x),int(y)): rows[DATAFRAME_COLUMNS].values.tolist()
+        for (x,y),rows in dataframe.groupby(['x','y']) }
+
+
+def _fingerprints_dict(dataframe):
+    if dataframe is None:
+        return {}
+    return {
+        (int(x),int(y)): fingerprint
+        for x,y,fingerprint in dataframe[['x','y','fingerprint']].values.tolist() }
+
+
+def _to_json(value):
+    """ numpy scalars as python values
+    """
+    if isinstance(value,np.generic):
+        return value.item()
+    if isinstance(value,(list,tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+def _csv_dataframe(dataframe):
+    """ copy of a clusters dataframe with the alerts and hulls as lists
+    """
+    dataframe=dataframe.copy()
+    dataframe['alerts']=dataframe['alerts'].apply(_to_list)
+    if 'hull' in dataframe:
+        dataframe['hull']=dataframe['hull'].apply(_to_list)
+    return dataframe
+
+
+def _to_list(arr):
+    if arr is None:
+        return None
+    return arr.tolist()
+
+
+def _to_array(values):
+    if values is None:
+        return None
+    return np.asarray(values).astype(int,copy=False)
+
+
 #
 # Main
 #
@@ -850,6 +1649,8 @@ def _get_kwargs(args, func):
 
 
 def _run(args):
+    if getattr(args,'stream_csv',False):
+        args.local=True
     service = _run_service(args)
     _save_service(service, args)
 
@@ -857,10 +1658,29 @@ def _run(args):
 def _run_service(args):
     service=_print_info(args,True)
     print("\nRUN: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
-    service.run()
-    nb_clusters,count,area,min_date,max_date=service.summary()
+    run_kwargs=_get_kwargs(args, service.run)
+    if run_kwargs.get('previous'):
+        run_kwargs['previous']=ClusterService.read_csv(
+            run_kwargs['previous'],
+            local=getattr(args,'local',False))
+    csv_stream=None
+    if getattr(args,'stream_csv',False):
+        if service.widths or service.min_counts:
+            raise Exception('Sweeps (widths/min_counts) can not be streamed to csv.')
+        csv_stream=CSVStream(service.filename(**_get_kwargs(args, service.filename)))
+        print("\tSTREAMING CLUSTERS TO: {}".format(csv_stream.path))
+        run_kwargs.update(stream=True,keep=False,callback=csv_stream)
+    service.run(**run_kwargs)
+    if csv_stream:
+        nb_clusters,count,area,min_date,max_date=csv_stream.summary()
+    else:
+        nb_clusters,count,area,min_date,max_date=service.summary()
     print("\tNB CLUSTERS: {}".format(nb_clusters))
     print("\tNB ERRORS: {}".format(service.errors().shape[0]))
+    print("\tNB SKIPPED TILES: {}".format(service.skipped()))
+    print("\tNB UNCHANGED TILES: {}".format(service.unchanged()))
+    for key,value in sorted(service.backend.stats.items()):
+        print("\t{}: {}".format(key.upper().replace('_',' '),value))
     print("\tTOTAL COUNT: {}".format(count))
     print("\tTOTAL AREA: {}".format(area))
     print("\tDATES: {} to {}".format(min_date,max_date))
@@ -870,6 +1690,8 @@ def _run_service(args):
 def _save_service(service, args):
 
     kwargs = _get_kwargs(args, ClusterService.save)
+    if getattr(args,'stream_csv',False):
+        kwargs['clusters']=False
 
     print("SAVE: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
     service.save(**kwargs)
@@ -881,6 +1703,9 @@ def _export(args):
 
     kwargs = _get_kwargs(args, ClusterService.export)
 
+    if getattr(args,'widths',None) or getattr(args,'min_counts',None):
+        raise Exception('Sweeps (widths/min_counts) can not be exported.')
+
     service = _run_service(args)
 
     print("EXPORT: {}".format(datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
@@ -902,6 +1727,7 @@ def _print_info(args,return_service=False):
     print("\twidth:",service.width)
     print("\tmin_count:",service.min_count)
     print("\titerations:",service.iterations)
+    print("\tengine:",service.engine)
     if return_service:
         return service
     else:
@@ -4,6 +4,8 @@ from skimage import io
 import matplotlib.pyplot as plt
 from glad_clusters.clusters.processors import glad_between_dates
 from glad_clusters.utils.service import ClusterService
+from glad_clusters.clusters.tile_cache import DecodedTileCache
+from glad_clusters.clusters.tile_cache import source_version
 
 DEFAULT_CENTROIDS=True
 DEFAULT_CONVEXT_HULL=False
@@ -18,6 +20,8 @@ CLUSTER_SIZE=20
 CLUSTER_COLOR='r'
 OVERLAY_ALPHA=0.75
 CONVEX_HULL_COLOR='#00ccff'
+TILE_CACHE_DIR=os.path.join(os.path.expanduser('~'),'.glad_clusters','tiles')
+TILE_CACHE=DecodedTileCache(TILE_CACHE_DIR)
 #
 #  
 #
@@ -29,6 +33,8 @@ class ClusterViewer(object):
         Args:
             service<cluster_service>: ClusterService instance
             url_base<str>: aws-bucket url for glad-tiles (defaults to environ['url'])        
+            tile_cache<DecodedTileCache>: decoded tile cache (defaults to TILE_CACHE,
+                shared by the viewers in the session)
     """
     @staticmethod
     def show(im=None,i=None,j=None,ax=None,alpha=1):
@@ -59,9 +65,10 @@ class ClusterViewer(object):
     #
     # PUBLIC METHODS
     #
-    def __init__(self,service,url_base=None):
+    def __init__(self,service,url_base=None,tile_cache=None):
         self.service=service
         self.url_base=url_base or os.environ.get('url')
+        self.tile_cache=tile_cache or TILE_CACHE
 
 
     def tile(self,
@@ -86,13 +93,13 @@ class ClusterViewer(object):
                 Other arguments:
 
                     show<bool[True]>: if true plot the image
-                    array<bool[False]>: if true return the array
+                    array<bool[False]>: if true return the (read-only) array
         """
         if row_id:
             if error: df=self.service.errors()
             else: df=self.service.dataframe(full=True)
             z,x,y=df[['z','x','y']].iloc[row_id]
-        arr=io.imread(self._url(z,x,y))
+        arr=self._tile_data(z,x,y)
         if show:
             ClusterViewer.show(arr)
         if array:
@@ -111,7 +118,7 @@ class ClusterViewer(object):
         nb_clusters,count,area,min_date,max_date=self.service.summary(rows)
         r=rows.iloc[0]
         arr=glad_between_dates(
-                io.imread(self._url(r.z,r.x,r.y)),
+                self._tile_data(r.z,r.x,r.y),
                 min_date,
                 max_date)
         if centroids:
@@ -143,7 +150,7 @@ class ClusterViewer(object):
         """
         row=self.service.cluster(row_id,full=True)
         count,area,z,x,y,i,j,min_date,max_date=self._cluster_info(row)
-        alerts=self._to_image(row.alerts)
+        alerts=self._to_image(self.service.alerts(row_id))
         if info:
             print("COUNT: {}".format(count))
             print("AREA: {}".format(area))
@@ -184,7 +191,7 @@ class ClusterViewer(object):
         fig, axs = plt.subplots(1,rows.shape[0], figsize=ROW_FIGSIZE)
         i=0
         for row_id,row in rows.iterrows():
-            self._cluster_axis(axs[i],row,centroids,convex_hull)
+            self._cluster_axis(axs[i],row_id,row,centroids,convex_hull)
             i+=1
         plt.show()
 
@@ -204,22 +211,26 @@ class ClusterViewer(object):
             min_date,max_date)
 
 
-    def _add_convex_hull(self,ax,row_id=None,alerts=None):
-        ch=self.service.convex_hull(row_id,alerts)
+    def _add_convex_hull(self,ax,row_id=None,alerts=None,hull=None):
+        if hull is None:
+            ch=self.service.convex_hull(row_id,alerts)
+        else:
+            ch=hull
         ax.fill(ch[:,1],ch[:,0],
             c=CONVEX_HULL_COLOR,
             zorder=-1)
 
 
-    def _cluster_axis(self,ax,row,centroids,convex_hull):
+    def _cluster_axis(self,ax,row_id,row,centroids,convex_hull):
         count,area,z,x,y,i,j,min_date,max_date=self._cluster_info(row)
-        alerts=self._to_image(row.alerts)
+        row_alerts=self.service.alerts(row_id)
+        alerts=self._to_image(row_alerts)
         title='count:{}, area:{}, pt:{},{}'.format(count,area,i,j)
         subtitle='dates: {}, {}'.format(min_date,max_date)
         if not centroids: i,j=None,None                
         if convex_hull:
             alpha=OVERLAY_ALPHA
-            self._add_convex_hull(ax,alerts=row.alerts)
+            self._add_convex_hull(ax,alerts=row_alerts,hull=row.get('hull'))
         else:
             alpha=1
         ClusterViewer.show(alerts,i,j,ax=ax,alpha=alpha)
@@ -244,3 +255,11 @@ class ClusterViewer(object):
         return URL_TMPL.format(self.url_base,z,x,y)
 
 
+    def _tile_data(self,z,x,y):
+        url=self._url(z,x,y)
+        return self.tile_cache.get(
+            z,x,y,
+            lambda: io.imread(url),
+            source_version(url))
+
+